@@ -51,6 +51,9 @@ def main():
     if o.delete:
         delete(cfg, o)
 
+    elif o.migrate_hash:
+        migrate(cfg, o)
+
     else:
         update(cfg, o, times)
 
@@ -90,6 +93,41 @@ def delete(cfg, o):
         else:
             break
 
+def migrate(cfg, o):
+    """Re-key remote repos to their configured hash algorithm."""
+
+    args = o.positional
+
+    # Check arguments:
+    if args and args[0] == 'all':
+      args = cfg.prefs['ALL']
+
+    for what in args:
+      # Read and check configs:
+      cfg.read_conf(what)
+      cfg.check()
+
+      repos = core.Repositories(opts=o, cfg=cfg, what=what)
+      core.message('repo', what=what, cfg=cfg)
+
+      core.say('Downloading index.dat...')
+      repos.get_index()
+
+      core.say('Reading remote md5tree...')
+      repos.read_remote()
+
+      if repos.remote_algo in (None, repos.algo):
+          core.say('Nothing to do: remote index already uses {0}'.format(repos.algo))
+      else:
+          core.say('Re-keying remote files...')
+          repos.migrate_hash()
+
+          core.say('Saving index.dat remotely...')
+          repos.save(local=False)
+
+      core.say('Cleaning up...')
+      repos.clean()
+
 def update(cfg, o, times):
     """Perform update."""
 
@@ -111,122 +149,69 @@ def update(cfg, o, times):
           print("[ERROR] Required local dir '{0}' not present".format(ldir))
           sys.exit()
 
-      # Initialize repo (read from pickle, if present and not o.fresh):
+      # Initialize repo (resuming previous interrupted run, if any and not o.fresh):
       repos = core.Repositories(opts=o, cfg=cfg, what=what)
-      if not o.fresh:
-          repos = repos.pickle(read=True)
-          repos.options = o # use currently user-given options, not pickled ones
+      if o.fresh:
+          repos.journal.clear()
+      elif repos.journal.replay():
+          core.say('Resuming interrupted run...')
 
       times.milestone('Read confs')
       
       # Print info:
       core.message('repo', what=what, cfg=cfg)
+
+      # Streaming mode takes a path of its own:
+      if o.stream:
+          update_stream(repos, o, times)
+          continue
       
       # --- Read remote data --- #
 
-      # Check if remote data already downloaded:
-      string = 'Downloading index.dat...'
-      if not o.fresh and 'dl_index' in repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          # Sync local proxy repo with remote repo:
-          core.say(string)
-          repos.get_index() # first download only index.dat.gpg
-
-          # Create flag to say "we already downloaded index.dat":
-          repos.done['dl_index'] = True
-      
-      # For each step, we pickle and log time:
-      repos.pickle()
+      # Sync local proxy repo with remote repo:
+      core.say('Downloading index.dat...')
+      repos.get_index() # first download only index.dat.gpg
       times.milestone('Download remote index')
 
       # Get remote md5tree:
-      string = 'Reading remote md5tree...'
-      if not o.fresh and 'read_index' in  repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          core.say(string)
-          repos.read_remote()
+      core.say('Reading remote md5tree...')
+      repos.read_remote()
 
-          # Create flag to say "we already read remote index.dat":
-          repos.done['read_index'] = True
+      # Remote index must use the same hash algorithm we do:
+      if repos.remote_algo not in (None, repos.algo):
+          fmt = 'Remote index uses {0} hashes, but repo is configured to use {1}. Run with --migrate-hash first.'
+          sys.exit(fmt.format(repos.remote_algo, repos.algo))
 
-      # For each step, we pickle and log time:
-      repos.pickle()
       times.milestone('Read remote index')
 
       # --- Read local data --- #
 
-      hash_file = os.path.join(cfg.dir, '{0}.md5'.format(what))
-      string = 'Reading local md5tree...'
-      if not o.fresh and 'read_local_md5s' in repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          # Read local file hashes from conf (for those files that didn't change):
-          core.say(string)
-          repos.read(hash_file)
-
-          # Create flag to say "we already read local md5 file":
-          repos.done['read_local_md5s'] = True
-      
-      # For each step, we pickle and log time:
-      repos.pickle()
+      # Read local file hashes from local state (for those files that didn't change):
+      core.say('Reading local md5tree...')
+      repos.read()
       times.milestone('Initialize')
 
       # Traverse source and get list of file hashes:
-      string = 'Finding new/different local files...'
-      if not o.fresh and 'check_local_files' in repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          core.say(string)
-          repos.walk()
-
-          # Create flag to say "we already checked local files":
-          repos.done['check_local_files'] = True
-      
-      # For each step, we pickle and log time:
-      repos.pickle()
+      core.say('Finding new/different local files...')
+      repos.walk()
       times.milestone('Dir walk')
       
       # --- Write back local data --- #
       
       # Save local hashes, be it dry or real run:
-      string = 'Saving local data...'
-      if not o.fresh and 'save_local_md5s' in repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          core.say(string)
-          repos.save(hash_file)
-
-          # Create flag to say "we already saved local MD5s":
-          repos.done['save_local_md5s'] = True
-      
-      # For each step, we pickle and log time:
-      repos.pickle()
+      core.say('Saving local data...')
+      repos.save()
       times.milestone('Save local hash')
       
       # --- Actually do stuff --- #
       
       # Compare remote and local md5 trees:
-      string = 'Comparing remote/local...'
-      if not o.fresh and 'compare_md5_trees' in repos.done:
-          core.say('[AVOIDED] {0}'.format(string))
-      else:
-          core.say(string)
-          repos.compare()
-
-          # Create flag to say "we already checked local files":
-          repos.done['compare_md5_trees'] = True
-      
-      # For each step, we pickle and log time:
-      repos.pickle()
+      core.say('Comparing remote/local...')
+      repos.compare()
       times.milestone('Compare')
       
       # Sort lists, for easy reading:
       repos.diff.sort()
-
-      # For each step, we pickle and log time:
-      repos.pickle()
       times.milestone('Sort diff')
       
       # Act according to differences in repos:
@@ -246,52 +231,21 @@ def update(cfg, o, times):
                   
           if repos.really_do:
               if not o.safe:
-                  if o.safe or not o.fresh and 'delete_remote' in repos.done:
-                      core.say('[AVOIDED] Deleting remote files...')
-                  else:
-                      string = 'Deleting remote files...'
-                      core.say(string)
-                      repos.nuke_remote()
-
-                      # Create flag to say "we already deleted remote files":
-                      repos.done['delete_remote'] = True
-
-              # For each step, we pickle and log time:
-              repos.pickle()
-              times.milestone('Nuke up')
+                  core.say('Deleting remote files...')
+                  repos.nuke_remote()
+                  times.milestone('Nuke up')
           
               # Safe or not safe, upload:
-              if not o.fresh and 'upload' in repos.done:
-                  core.say('[AVOIDED] Uploading...')
-              else:
-                  string = 'Uploading...'
-                  core.say(string)
-                  success = repos.upload()
-
-                  # Create flag to say "we already uploaded files":
-                  if success:
-                      repos.done['upload'] = True
-                  
-              # For each step, we pickle and log time:
-              repos.pickle()
+              core.say('Uploading...')
+              success = repos.upload()
               times.milestone('Upload')
 
               if not success:
                   sys.exit()
                 
               # Write index file to remote repo:
-              if not o.fresh and 'write_remote_index' in repos.done:
-                  core.say('[AVOIDED] Saving index.dat remotely...')
-              else:
-                  string = 'Saving index.dat remotely...'
-                  core.say(string)
-                  repos.save('index.dat', local=False)
-
-                  # Create flag to say "we already wrote remote index":
-                  repos.done['write_remote_index'] = True
-
-              # For each step, we pickle and log time:
-              repos.pickle()
+              core.say('Saving index.dat remotely...')
+              repos.save(local=False)
               times.milestone('Write remote index')
 
       ############
@@ -308,53 +262,24 @@ def update(cfg, o, times):
                       
           if repos.really_do:
               if not o.safe:
-                  if not o.fresh and 'delete_local' in repos.done:
-                      core.say('[AVOIDED] Deleting local files...')
-                  else:
-                      # Delete files only in local:
-                      repos.nuke_local()
-
-                      # Create flag to say "we already deleted local files":
-                      repos.done['delete_local'] = True
-                      
-                  # For each step, we pickle and log time:
-                  repos.pickle()
+                  # Delete files only in local:
+                  repos.nuke_local()
                   times.milestone('Nuke local')
 
               # Safe or not, download:
-              if not o.fresh and 'download' in repos.done:
-                  core.say('[AVOIDED] Downloading...')
-              else:
-                  string = 'Downloading...'
-                  core.say(string)
-                  success = repos.download()
-
-                  # Create flag to say "we already downloaded remote files":
-                  repos.done['download'] = True
-              
-              # For each step, we pickle and log time:
-              repos.pickle()
+              core.say('Downloading...')
+              success = repos.download()
               times.milestone('Download')
 
               if not success:
                   sys.exit()
 
               # Save logs:
-              repos.save(hash_file)
+              repos.save()
 
               # Write index file to remote repo:
-              if not o.fresh and 'write_remote_index' in repos.done:
-                  core.say('[AVOIDED] Saving index.dat remotely...')
-              else:
-                  string = 'Saving index.dat remotely...'
-                  core.say(string)
-                  repos.save('index.dat', local=False)
-
-                  # Create flag to say "we already wrote remote index":
-                  repos.done['write_remote_index'] = True
-
-              # For each step, we pickle and log time:
-              repos.pickle()
+              core.say('Saving index.dat remotely...')
+              repos.save(local=False)
               times.milestone('Save remote index')
 
       # Cleanup, either because all went well, or because 
@@ -366,6 +291,65 @@ def update(cfg, o, times):
 
       times.milestone('Finalize')
 
+def update_stream(repos, o, times):
+    """Perform update of a single repo in streaming mode (see --stream), with
+    bounded memory."""
+
+    core.say('Downloading index.dat...')
+    repos.get_index()
+    remote_files = repos.decrypt_index()
+    times.milestone('Download remote index')
+
+    # Walk, hash, save local hashes and compare, in a single pass:
+    core.say('Comparing remote/local...')
+    repos.stream_compare(remote_files)
+    times.milestone('Compare')
+
+    success = False
+    repos.really_do = False
+
+    # Print summary/info, and ask for permission to proceed:
+    repos.enumerate()
+    any_diff = repos.ask(up=o.up)
+
+    if repos.really_do:
+        if o.up:
+            if not o.safe:
+                core.say('Deleting remote files...')
+                repos.stream_nuke_remote()
+                times.milestone('Nuke up')
+
+            core.say('Uploading...')
+            success = repos.stream_upload()
+            times.milestone('Upload')
+
+        else:
+            if not o.safe:
+                repos.stream_nuke_local()
+                times.milestone('Nuke local')
+
+            core.say('Downloading...')
+            success = repos.stream_download()
+            times.milestone('Download')
+
+        if not success:
+            sys.exit()
+
+        if not o.up:
+            repos.stream_save_local()
+
+        core.say('Saving index.dat remotely...')
+        repos.stream_save_remote(remote_files)
+        times.milestone('Save remote index')
+
+    # Cleanup, either because all went well, or because
+    # there was nothing to do:
+    if success or not any_diff:
+        core.say('Cleaning up...')
+        repos.clean()
+
+    times.milestone('Finalize')
+
 
 # Main:
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+"""
+Content-defined chunking of big files (see CHUNK_FILES in README), so that
+changing some part of a file (e.g. appending to it) only takes uploading (and
+downloading) the chunks that changed, not the whole file again. Chunks are cut
+where a rolling (gear) hash of the last WINDOW bytes has some bits all zero, so
+cuts depend on the contents around them only, and move along with them when
+bytes are inserted or removed elsewhere (see cut()).
+
+Each chunk is GPG-ed and stored in the chunks/ dir of the remote repo, named after
+its hash. Which chunks the contents with each hash are made of is kept in a map,
+GPG-ed and uploaded along with the remote index, as chunks.dat. It is a text
+file, like this:
+
+    #hash=<algo>
+    #chunks=<algo>                                  (of the chunk hashes)
+    <hash>|<chunk hash>:<size>,<chunk hash>:<size>,...   (one line per hash)
+"""
+
+# Standard libs:
+import os
+import hashlib
+
+# Optional libs:
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Constants:
+WINDOW = 32               # bytes the rolling hash depends on
+MIN_BITS, MAX_BITS = 16, 28 # average chunk size goes from 64 kB to 256 MB
+
+# Random (but fixed) value for each byte value, for the rolling hash:
+GEAR = [ int.from_bytes(hashlib.md5(bytes([i])).digest()[:4], 'little') for i in range(256) ]
+
+# Functions:
+def split(f, size):
+    """Yield the contents of file object "f" (read until EOF), cut in chunks
+    of "size" bytes on average (rounded down to a power of 2): at least a
+    quarter of that, and at most four times that (see cut())."""
+
+    bits = min(MAX_BITS, max(MIN_BITS, size.bit_length() - 1))
+    lo, hi, mask = 1 << (bits - 2), 1 << (bits + 2), (1 << bits) - 1
+
+    buf = bytearray()
+    eof = False
+    while True:
+        # Have at least "hi" bytes at hand, for cuts not to depend on reads:
+        while not eof and len(buf) < hi:
+            data = f.read(hi)
+            eof = not data
+            buf += data
+
+        if not buf:
+            return
+
+        n = cut(buf, lo, hi, mask)
+        yield bytes(buf[:n])
+        del buf[:n]
+
+def cut(data, lo, hi, mask):
+    """Return the length of the first chunk of "data" (bytes-like): up to the
+    first byte (from byte "lo" on) where the rolling hash has all bits in "mask"
+    zero, or "hi" bytes (or the whole of "data") if there is no such byte. The
+    hash at each byte is the sum of GEAR[b] << k of the WINDOW bytes "b" up to
+    it, "k" bytes back (modulo 2**32). Done with NumPy, if available."""
+
+    n = min(len(data), hi)
+    if n <= lo:
+        return n
+
+    if np is not None:
+        return cut_numpy(data, lo, n, mask)
+
+    h = 0
+    for i in range(lo - WINDOW, n):
+        h = ((h << 1) + GEAR[data[i]]) & 0xffffffff
+        if i >= lo - 1 and not h & mask:
+            return i + 1
+
+    return n
+
+def cut_numpy(data, lo, n, mask):
+    """Same as cut(), for "n" bytes at most, with NumPy. The hashes of many bytes
+    are calculated at once, summing those of windows half as long each time."""
+
+    gear = np.array(GEAR, dtype=np.uint32)
+    step = 4*lo # bytes checked at a time (about the average chunk size)
+
+    a = np.frombuffer(data, dtype=np.uint8, count=n)
+    i = lo - 1 # first byte to check
+    while i < n:
+        end = min(n, i + step)
+        h = gear[a[i-WINDOW+1:end]]
+        k = 1
+        while k < WINDOW:
+            h[k:] += h[:-k] << np.uint32(k)
+            k *= 2
+
+        hits = np.flatnonzero((h[WINDOW-1:] & np.uint32(mask)) == 0)
+        if len(hits):
+            return i + int(hits[0]) + 1
+        i = end
+
+    return n
+
+def encode(members):
+    """Return list of (chunk hash, size) tuples "members" as a string, as saved
+    in the map (see ChunkMap.write())."""
+
+    return ','.join([ '{0}:{1}'.format(chunk, size) for chunk, size in members ])
+
+def decode(string):
+    """Inverse of encode() (returns a tuple)."""
+
+    members = []
+    for member in string.split(','):
+        chunk, _, size = member.partition(':')
+        members.append((chunk, int(size)))
+
+    return tuple(members)
+
+# Classes:
+class ChunkMap(object):
+    """Map of the chunks that the contents of chunked files are made of, by the
+    hash of the contents, calculated with algorithm "algo". Chunks are named after
+    their hash, calculated with algorithm "chunk_algo": that of the map when it
+    was first made, kept as it is when re-keyed (see rekey())."""
+
+    def __init__(self, algo):
+        self.algo = algo
+        self.chunk_algo = algo
+        self.files = {} # dict of hash -> tuple of (chunk hash, size) tuples
+        self.changed = False
+
+    def __contains__(self, hash):
+        return hash in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, hash):
+        """Return tuple of (chunk hash, size) tuples of "hash", in order."""
+
+        return self.files[hash]
+
+    def read(self, fn):
+        """Read map from file "fn"."""
+
+        with open(fn) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('#'):
+                    k, _, v = line[1:].partition('=')
+                    if k == 'hash':
+                        self.algo = v
+                    elif k == 'chunks':
+                        self.chunk_algo = v
+
+                elif line:
+                    hash, _, members = line.partition('|')
+                    self.files[hash] = decode(members)
+
+    def write(self, fn):
+        """Write map to file "fn"."""
+
+        with open(fn + '.tmp', 'w') as f:
+            f.write('#hash={0}\n'.format(self.algo))
+            f.write('#chunks={0}\n'.format(self.chunk_algo))
+            for hash, members in sorted(self.files.items()):
+                f.write('{0}|{1}\n'.format(hash, encode(members)))
+        os.replace(fn + '.tmp', fn)
+
+    def add(self, hash, members):
+        """Add "hash", made of "members", a list of (chunk hash, size) tuples."""
+
+        self.files[hash] = tuple(members)
+        self.changed = True
+
+    def chunks(self):
+        """Return set of hashes of all chunks."""
+
+        return set( chunk for members in self.files.values() for chunk, size in members )
+
+    def keep(self, hashes):
+        """Forget all hashes but those in "hashes" (e.g. a set). Return set of the
+        chunks that only forgotten hashes were made of."""
+
+        dead = [ h for h in self.files if not h in hashes ]
+        if not dead:
+            return set()
+
+        old = self.chunks()
+        for h in dead:
+            del self.files[h]
+        self.changed = True
+
+        return old - self.chunks()
+
+    def rekey(self, rekey, algo):
+        """Re-key hashes to algorithm "algo", as given by "rekey" (dict of old
+        hash -> new hash). Hashes not in it are forgotten. Chunks keep their
+        names."""
+
+        self.files = dict( (rekey[h], members) for h, members in self.files.items() if h in rekey )
+        self.algo = algo
+        self.changed = True
@@ -1,14 +1,39 @@
 import re
 import os
 import sys
+import mmap
+import stat
 import time
 import json
+import heapq
+import queue
+import fcntl
+import struct
 import shutil
+import shlex
+import array
 import pickle
+import zlib
 import hashlib
 import datetime
 import argparse
+import threading
+import collections
 import subprocess as sp
+from concurrent import futures
+
+# Optional libs:
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Our libs:
+from libgipsync import index
+from libgipsync import stream
+from libgipsync import state
+from libgipsync import packs
+from libgipsync import cdc
 
 # Functions:
 def parse_args():
@@ -82,6 +107,39 @@ def parse_args():
                       action="store_true",
                       default=False)
 
+    parser.add_argument("--migrate-hash",
+                      help="Re-key the remote repo (blob names and index) to the hash algorithm set in the repo configuration, without uploading anything. Default: don't.",
+                      action="store_true",
+                      default=False)
+
+    parser.add_argument("-j", "--jobs",
+                      help="Number of parallel workers used to hash and GPG files. Default: number of CPUs.",
+                      type=int,
+                      default=None)
+
+    parser.add_argument("--trust-dirs",
+                      dest="trust_dirs",
+                      help="Do not list again local dirs whose mtime did not change since last run, but take the names of the files in them from last run (which are stat-ed anyway, to notice the ones modified in place). Ignored with --force-hash. Default: list all dirs.",
+                      action="store_true",
+                      default=False)
+
+    parser.add_argument("--stream",
+                      help="Streaming mode, for repos with too many files to hold in memory: walk, compare, transfer and save indexes as streams sorted by name, spilled to disk. Default: don't.",
+                      action="store_true",
+                      default=False)
+
+    parser.add_argument("--tmp-budget",
+                      dest="tmp_budget",
+                      help="Use at most SIZE (e.g. 500M, 10G) of disk space for GPG files staged in the temporary dir, uploading or putting into place each batch of files before staging more. Files bigger than that are piped instead, as with --pipe. Default: no limit.",
+                      metavar='SIZE',
+                      type=size2bytes,
+                      default=None)
+
+    parser.add_argument("--pipe",
+                      help="Pipe files straight from gpg to the remote repo, through SSH (see README), and back, instead of staging the GPG files in the temporary dir and transferring them with rsync. Default: don't.",
+                      action="store_true",
+                      default=False)
+
 
     return parser.parse_args()
 
@@ -123,19 +181,108 @@ def fitit(path,limit=None):
 
   return newpath
 
-def hashof(fn):
-    """Calc hash function for file."""
+# Supported hash algorithms (all give 16-byte digests):
+HASH_ALGOS = {
+    'md5'     : hashlib.md5,
+    'blake2b' : lambda: hashlib.blake2b(digest_size=16),
+}
+
+# Suffix of files being downloaded into place (see Repositories.unpack()):
+PART_SUFFIX = '.gipsync-part'
+
+# Tuning of hashof():
+HASH_BUFSIZE = 1024*1024       # size of read buffer (bytes)
+HASH_MMAP_MIN = 64*1024*1024   # files this big (bytes) or bigger are mmap-ed instead of read
+_hash_buffers = threading.local() # one reusable read buffer per (hashing) thread
+
+# Compression of GPG-ed files (see Repositories.compressible()):
+COMPRESS_MODES = ('auto', 'always', 'never')
+COMPRESS_SAMPLE = 64*1024 # bytes read from start of file, to check if compressible
+COMPRESS_RATIO = 0.95     # samples not compressing below this ratio are deemed incompressible
+COMPRESS_MIN = 4*1024     # samples smaller than this are not checked (zlib overhead would dominate)
+INCOMPRESSIBLE = [ # extensions of files (usually) compressed already
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.wmv',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.7z', '.rar', '.jar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+    '.gpg', '.pgp', '.asc', '.age',
+]
+
+def hashof(fn, algo='md5'):
+    """Calc hash function "algo" (see HASH_ALGOS) for file."""
+
+    return hashesof(fn, [algo])[0]
+
+def hashesof(fn, algos):
+    """Calc hash functions "algos" (list of names in HASH_ALGOS) for file, reading
+    it only once. Return list of hashes.
+
+    Small files are read with readinto() into a big buffer that is reused
+    across calls (one per thread). Big files are mmap-ed instead. In both
+    cases the kernel is told that we read sequentially, and that we do not
+    need the pages in the cache afterwards.
+    """
 
-    h = hashlib.md5()
+    hs = [ HASH_ALGOS[algo]() for algo in algos ]
 
-    with open(fn,'rb') as f:
-        while True:
-            t = f.read(4096)
-            if len(t) == 0:
-                break
-            h.update(t)
+    with open(fn, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+
+        if size >= HASH_MMAP_MIN:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                for h in hs:
+                    h.update(m)
+        else:
+            try:
+                buf, view = _hash_buffers.buf, _hash_buffers.view
+            except AttributeError:
+                buf = bytearray(HASH_BUFSIZE)
+                view = memoryview(buf)
+                _hash_buffers.buf, _hash_buffers.view = buf, view
+
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                for h in hs:
+                    h.update(view[:n])
+
+        fadvise(fd, 'POSIX_FADV_DONTNEED')
     
-    return h.hexdigest()
+    return [ h.hexdigest() for h in hs ]
+
+def hash_stream(f, algos, out=None):
+    """Calc hash functions "algos" for the content of file object "f", read
+    until EOF (and written to file object "out" as it is read, if given).
+    Return list of hashes."""
+
+    hs = [ HASH_ALGOS[algo]() for algo in algos ]
+
+    while True:
+        t = f.read(HASH_BUFSIZE)
+        if not t:
+            break
+        for h in hs:
+            h.update(t)
+        if out:
+            out.write(t)
+
+    return [ h.hexdigest() for h in hs ]
+
+def fadvise(fd, advice):
+    """Give access pattern advice "advice" (name of os.POSIX_FADV_* constant) for
+    whole file with descriptor "fd", if the platform supports it."""
+
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass # e.g. not supported by the underlying filesystem
 
 def bytes2size(bytes):
     """Get a number of bytes, and return in human-friendly form (kB, MB, etc)."""
@@ -150,14 +297,96 @@ def bytes2size(bytes):
 
     return '%.2f %s' % (sz, units[i])
 
-def find_exc(it, patts):
-    """Return True if item "it" matches some pattern in "patts", False otherwise."""
+def size2bytes(string):
+    """Get a size in human-friendly form (e.g. "10G", "1.5T", "500k", or a plain
+    number of bytes), and return it in bytes."""
 
-    for patt in patts:
-        if patt in it:
-            return True
+    units = 'BKMGT'
+
+    string = string.strip().upper().rstrip('B') or '0'
+    i = 0
+    if string[-1] in units:
+        i = units.index(string[-1])
+        string = string[:-1]
+
+    return int(float(string) * 1024**i)
+
+def scantree(top, excluder, dir_cache=None):
+    """Walk dir "top" with os.scandir(), and yield (name, DirEntry) for each
+    entry that is not a dir, where "name" is the path relative to "top". Dirs
+    matching "excluder" are not descended into, nor are symlinks to dirs.
+    If a DirCache "dir_cache" is given, dirs unchanged since it was saved are
+    not listed: (name, None) is yielded for each (non-symlink) file in them
+    instead, as cached."""
+
+    stack = ['']
+    while stack:
+        prs = stack.pop()
+        path = os.path.join(top, prs)
+
+        if dir_cache is not None:
+            # Stat before listing, so that changes while listing are noticed next time:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            cached = dir_cache.get(prs, st)
+            if cached:
+                files, dirs = cached
+                for fn in files:
+                    yield prs + fn, None
+                stack.extend([ prs + dn + '/' for dn in dirs ])
+                continue
+
+            files, dirs = [], []
+
+        try:
+            it = os.scandir(path)
+        except OSError:
+            continue # e.g. not readable
+
+        with it:
+            for entry in it:
+                name = prs + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if not entry.is_symlink() and not excluder.match(name):
+                        stack.append(name + '/')
+                        if dir_cache is not None:
+                            dirs.append(entry.name)
+                else:
+                    if dir_cache is not None and not entry.is_symlink():
+                        files.append(entry.name)
+                    yield name, entry
+
+        if dir_cache is not None:
+            dir_cache.set(prs, st, files, dirs)
+
+# ioctl to get the extent map of a file (Linux), see linux/fiemap.h:
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = '=QQLLLL' # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT_SIZE = 56
+
+def first_extent(fn):
+    """Return physical offset (bytes) on disk of first extent of file "fn", or 0
+    if it has none. Raise OSError if the filesystem does not support FIEMAP."""
+
+    hsize = struct.calcsize(FIEMAP_HEADER)
+    buf = bytearray(struct.pack(FIEMAP_HEADER, 0, 2**64 - 1, 0, 0, 1, 0))
+    buf += bytes(FIEMAP_EXTENT_SIZE)
 
-    return False
+    with open(fn, 'rb') as f:
+        fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+
+    if not struct.unpack_from('=L', buf, 20)[0]: # fm_mapped_extents
+        return 0
+
+    return struct.unpack_from('=Q', buf, hsize + 8)[0] # fe_physical of 1st extent
 
 def collect_sizes(dir):
     """Collect the size of all data in remote repo (mounted locally by SSHFS)."""
@@ -249,6 +478,31 @@ def s2hms(seconds):
 
     return string
 
+def chunks(items, size, maxbytes=None, sizeof=None):
+    """Yield lists of up to "size" items, from iterable "items". If "maxbytes" is
+    given, lists are also cut before they add up to more than "maxbytes" bytes,
+    with function "sizeof" giving the bytes of each item (an item bigger than that
+    goes alone)."""
+
+    chunk = []
+    nbytes = 0
+    for item in items:
+        if maxbytes is not None:
+            n = sizeof(item)
+            if chunk and nbytes + n > maxbytes:
+                yield chunk
+                chunk = []
+                nbytes = 0
+            nbytes += n
+
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+            nbytes = 0
+    if chunk:
+        yield chunk
+
 def get_present_files(server, dir, files):
     """Returns a list of which files of the list "files" is present in directory "dir",
     in server "server"."""
@@ -283,6 +537,15 @@ def get_present_files(server, dir, files):
 
     return present
 
+def shard_blobs(manifest):
+    """Return sorted list of names of the shards listed in "manifest" of a
+    remote index (see Repositories.send_shards()), which may be None."""
+
+    if not manifest:
+        return []
+
+    return sorted([ '{0}.{1}'.format(i, d) for i, d in manifest['digests'].items() ])
+
 def message(which, what, cfg):
     if which == 'repo':
         fmt = "\nRepository: \033[34m{0}\033[0m @ \033[34m{1}\033[0m"
@@ -400,6 +663,44 @@ class Configuration(object):
                 string = fmt.format(var)
                 sys.exit(string)
 
+        # Hash algorithm, if given, must be known:
+        algo = self.conf.get('HASH', 'md5')
+        if not algo in HASH_ALGOS:
+            fmt = 'Sorry, but hash algorithm "{0}" is not supported (use one of: {1})'
+            string = fmt.format(algo, ', '.join(sorted(HASH_ALGOS)))
+            sys.exit(string)
+
+        # Index format, if given, must be known:
+        if not self.conf.get('INDEX_FORMAT', 'text') in ('text', 'binary'):
+            fmt = 'Sorry, but index format "{0}" is not supported (use "text" or "binary")'
+            string = fmt.format(self.conf['INDEX_FORMAT'])
+            sys.exit(string)
+
+        # Compression mode, if given, must be known:
+        if not self.conf.get('COMPRESS', 'auto') in COMPRESS_MODES:
+            fmt = 'Sorry, but compression mode "{0}" is not supported (use one of: {1})'
+            string = fmt.format(self.conf['COMPRESS'], ', '.join(COMPRESS_MODES))
+            sys.exit(string)
+
+        # Pack and chunk sizes, if given, must be sizes:
+        for var in 'PACK_FILES', 'PACK_SIZE', 'CHUNK_FILES', 'CHUNK_SIZE':
+            try:
+                size2bytes(str(self.conf.get(var, 0)))
+            except ValueError:
+                fmt = 'Sorry, but "{0}" is not a valid size for {1} (use e.g. 64k, or 32M)'
+                string = fmt.format(self.conf[var], var)
+                sys.exit(string)
+
+        # Number of index shards, if given, must be sensible:
+        try:
+            shards = int(self.conf.get('INDEX_SHARDS', 0))
+        except ValueError:
+            shards = -1
+        if not 0 <= shards <= 256:
+            fmt = 'Sorry, but "{0}" index shards is not supported (use an integer from 0 to 256)'
+            string = fmt.format(self.conf['INDEX_SHARDS'])
+            sys.exit(string)
+
         for var in ['RECIPIENTS', 'REMOTE']:
             if not var in self.prefs:
                 fmt = 'Sorry, but variable "{0}" is not specified in global config file'
@@ -408,20 +709,49 @@ class Configuration(object):
 
 class Repositories(object):
     """All the data about both local and remote repos."""
+
+    CHUNK = 1000 # files handled (e.g. transferred) at a time
+    CHUNK_BYTES = 256*1024*1024 # bytes downloaded at a time (at most), see download()
+    STREAM_SIZE = 1024*1024 # GPG files this big (bytes) or bigger are un-GPG-ed one by one, see unpack()
   
     def __init__(self, opts, cfg, what):
-        self.files        = {}        # dict of filename/file object
-        self.files_read   = {}        # dict of file names:true (to check pertenence)
-        self.files_local  = {}        # dict of file names:true (to check pertenence)
-        self.files_remote = {}        # dict of file names:true (to check pertenence)
+        self.files        = FileTable(self) # data of all files, by name
         self.tmpdir       = None      # temporary directory
         self.gpgcom       = '/usr/bin/gpg --yes  -q' # command to encrypt/decrypt with GPG
         self.walked       = 0          # total considered files
         self.hashed       = 0          # total files for which hash was calculated
+        self.hashed_bytes = 0          # total bytes read to calculate hashes
+        self.hashed_time  = 0          # total time (s) spent calculating hashes
         self.diff         = RepoDiff() # difference between repos
         self.options      = opts       # optparse options
-        self.done         = {}         # list of steps done
         self.cfg          = cfg        # Configuration object holding all config and prefs
+        self.excluder     = Excluder(cfg.conf['EXCLUDES'] + ['glob:*' + PART_SUFFIX], cfg.conf['LOCALDIR']) # matcher of excluded paths
+        self.algo         = cfg.conf.get('HASH', 'md5') # hash algorithm to use
+        self.remote_algo  = None       # hash algorithm used by remote index (None if empty)
+        self.binary_index = cfg.conf.get('INDEX_FORMAT') == 'binary' # write indexes in binary format?
+        self.hash_cache   = HashCache(os.path.join(cfg.dir, '{0}.hcache'.format(what)), self.algo)
+        self.dir_cache    = DirCache(os.path.join(cfg.dir, '{0}.dcache'.format(what)))
+        self.hash_file    = os.path.join(cfg.dir, '{0}.md5'.format(what)) # local hash file of older versions
+        self.state        = state.LocalState(os.path.join(cfg.dir, '{0}.db'.format(what)), self.algo) # local state
+        self.index_shards = int(cfg.conf.get('INDEX_SHARDS', 0)) # shards to split remote index into (0 for none)
+        self.index_cache  = os.path.join(cfg.dir, '{0}.index'.format(what)) # local copy of remote index
+        self.manifest     = None       # manifest of remote index shards (None if not sharded)
+        self.generation   = None       # generation id of remote index, see get_index()
+        self.stamp        = None       # size and mtime of remote index file(s), see index_stamp()
+        self.index_reused = False      # whether local copy of remote index is used, see get_index()
+        self.local_dirs   = None       # digests of local dirs (see index.DirDigests), see save()
+        self.remote_dirs  = None       # digests of dirs of remote index, see read_remote()
+        self.budget       = Budget(opts.tmp_budget) # disk space for files staged in tmpdir, see --tmp-budget
+        self.compress     = cfg.conf.get('COMPRESS', 'auto') # when to compress GPG-ed files, see compressible()
+        self.incompressible = set( e.lower() for e in cfg.conf.get('INCOMPRESSIBLE', INCOMPRESSIBLE) ) # extensions not to compress
+        self.uncompressed = [0, 0]     # number and total size of files GPG-ed without compression
+        self.pack_files   = size2bytes(str(cfg.conf.get('PACK_FILES', 0))) # files smaller than this are packed (0 for none)
+        self.pack_size    = size2bytes(str(cfg.conf.get('PACK_SIZE', '32M'))) # size of packs
+        self.catalog      = packs.Catalog(self.algo) # which packs hold which hashes, see read_catalog()
+        self.chunk_files  = size2bytes(str(cfg.conf.get('CHUNK_FILES', 0))) # files this big or bigger are chunked (0 for none)
+        self.chunk_size   = size2bytes(str(cfg.conf.get('CHUNK_SIZE', '4M'))) # average size of chunks
+        self.chunkmap     = cdc.ChunkMap(self.algo) # which chunks chunked hashes are made of, see read_chunkmap()
+        self.lock         = threading.Lock() # for counters updated from worker threads
         self.really_do = False
         self.tmpdir = os.path.join(self.cfg.dir, 'ongoing.{0}'.format(what))
 
@@ -432,182 +762,540 @@ class Repositories(object):
         else:
             self.rsync = 'rsync -rto'
 
-        # Create tmp dir if necessary:
-        try:
-            os.makedirs(os.path.join(self.tmpdir, 'data'))
-        except:
-            pass # if it already exists
+        # Create tmp dir (and local cache of remote index) if necessary:
+        for dir in os.path.join(self.tmpdir, 'data'), os.path.join(self.tmpdir, 'index'), os.path.join(self.tmpdir, 'packs'), os.path.join(self.tmpdir, 'chunks'), self.index_cache:
+            try:
+                os.makedirs(dir)
+            except:
+                pass # if it already exists
+
+        # Journal of what is done, to resume interrupted runs:
+        self.journal = Journal(os.path.join(self.tmpdir, 'journal'))
+
+        # Import local hash file of older versions, if no local state saved yet:
+        if self.state.empty() and os.path.isfile(self.hash_file):
+            self.state.load_index(self.hash_file)
         
         # Make gpg more verbose?:
         if self.options.verbosity < 1:
             self.gpgcom += ' --no-tty '
 
-    def read(self, fromfile):
-        if os.path.isfile(fromfile):
-            for k,v in conf2dic(fromfile,separator='|').items():
-                self.files_read[k] = True
-                
-                av = v.split(':')
-                
-                if len(av) < 2:
-                    msj = 'The length of dictionary entry "{0}={1}" is too short!'.format(k,v)
-                    sys.exit(msj)
-                if not k in self.files:
-                    self.files[k] = Fileitem(name=k, repos=self)
-                self.files_read[k] = True
-                self.files[k].hash_read = av[0]
-                self.files[k].size_read = float(av[1])
-                self.files[k].mtime_read = float(av[2])
-        else:
-            msj = 'Can\'t read from non existint file "{0}"!'.format(fromfile)
-            sys.exit(msj)
+    def read(self):
+        """Read local state, as of last run."""
 
-    def dict2files(self, dict, here=True):
-        fi = {}
+        for k, hash, size, mtime, mtime_ns, inode in self.read_state():
+            v = self.files.add(k)
+            v.flags |= READ
+            v.hash_read = hash
+            v.size_read = size
+            v.mtime_read = mtime
+            v.mtime_ns = mtime_ns
+            v.inode = inode
 
-        for k,v in dict.items():
-            av = v.split(':')
-            
-            if len(av) < 2:
-                msj = 'The length of dictionary entry "{0}|{1}" is too short!'.format(k, v)
-                sys.exit(msj)
-            fi[k] = Fileitem(repos=self)
-            fi[k].name = k
-            
-            if here:
-                fi[k].hash_local  = av[0]
-                fi[k].size_local  = float(av[1])
-                fi[k].mtime_local = float(av[2])
-                
-            else:
-                fi[k].hash_remote  = av[0]
-                fi[k].size_remote  = float(av[1])
-                fi[k].mtime_remote = float(av[2])
-                
-        return fi
+    def read_state(self):
+        """Return iterator over the entries of the local state (see
+        state.LocalState.entries()), or an empty one if it holds hashes
+        calculated with some other algorithm (which are of no use)."""
+
+        if self.state.stale():
+            if self.options.verbosity > 0:
+                fmt = '[INFO] Ignoring "{0}", which holds {1} hashes (not {2})'
+                print(fmt.format(self.state.fn, self.state.get('hash'), self.algo))
+            return iter(())
+
+        return self.state.entries()
 
     def walk(self):
         """Perform the acts upon each dir in the dir walk (get mtimes, MD5s, etc)."""
   
         pl = self.cfg.conf['LOCALDIR']
+        pending = [] # (name, stat) of files whose hash must be calculated
+        self.hash_cache.read()
+
+        # Do not list unchanged dirs, if so asked:
+        dir_cache = None
+        if self.trust_dirs():
+            dir_cache = self.dir_cache
+            dir_cache.read(self.dir_token())
   
-        for path, dirs, files in os.walk(pl):
-            prs = path.replace(pl+'/','')
+        for fname, entry in scantree(pl, self.excluder, dir_cache):
+            self.walked += 1
+
+            # In a dir unchanged since last run (not listed again), stat the files
+            # anyway, as modifying them in place leaves the mtime of the dir alone:
+            if entry is None:
+                if self.excluder.match(fname):
+                    continue
+
+                try:
+                    st = os.lstat(os.path.join(pl, fname))
+                except OSError:
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    continue
+
+                v = self.files.add(fname)
+                v.flags |= LOCAL
   
-            # Ignore dif if excluded:
-            if not find_exc(prs, self.cfg.conf['EXCLUDES']):
-                for file in files:
-                    self.walked += 1
-      
-                    fn = os.path.join(path, file)
-      
-                    # Ignore excluded files and symlinks (in ORs, check first
-                    # the cheapest and most probable condition, to speed up):
-                    if not os.path.islink(fn) and not find_exc(fn, self.cfg.conf['EXCLUDES']):
-                        if path == pl: # current path is root path
-                            fname = file
-                        else: # it's a subdir of root
-                            fname = '%s/%s' % (prs, file)
-                        if not fname in self.files:
-                            self.files[fname] = Fileitem(repos=self)
-                        self.files[fname].name  = fname
-                        self.files_local[fname] = True
-                        
-                        mt = int(os.path.getmtime(fn))
-                        time_differ = False
-                        
-                        # Get file mtime:
-                        try:
-                            rmt = self.files[fname].mtime_read
-                            #rmt = long(float(rmt))
-                            rmt = float(rmt)
-                            
-                            if rmt - mt != 0:
-                                time_differ = True
-                        except:
-                            time_differ = True
-                        if self.options.force_hash or time_differ:
-                            # Calc hash and save data:
-                            try:
-                                old_hash = self.files[fname].hash_read
-                            except:
-                                old_hash = -1 # if file is not in "read_files", give it a hash no-one can have
-                            new_hash = self.files[fname].get_hash()
-                            self.hashed += 1
-                            
-                            #if old_hash != new_hash: # (avoid mtime-ing unchanged files)
-                            if True: # mtime all files, even unchanged ones
-                                if self.options.verbosity > 0:
-                                    print('[MD5] {0}'.format(fitit(fname)))
-                                self.files[fname].hash_local = new_hash
-                                self.files[fname].get_size()
-                                self.files[fname].mtime_local = mt
-        
-                            else:
-                                self.files[fname].hash_local = old_hash
-                                self.files[fname].size_local = self.files[fname].size_read
-                                self.files[fname].mtime_local = self.files[fname].mtime_read
-                        else:
-                            # Skip, because it's the same file (relying on mtime here):
-                            self.files[fname].hash_local  = self.files[fname].hash_read
-                            self.files[fname].size_local  = self.files[fname].size_read
-                            self.files[fname].mtime_local = self.files[fname].mtime_read
-        
-                            if self.options.verbosity > 2: # VERY verbose!
-                                print('[SKIP]: {0}'.format(fitit(fname)))
+            # Ignore symlinks and excluded files (in ORs, check first
+            # the cheapest and most probable condition, to speed up):
+            elif not entry.is_symlink() and not self.excluder.match(fname):
+                v = self.files.add(fname)
+                v.flags |= LOCAL
+                st = entry.stat(follow_symlinks=False)
+
+            else:
+                continue
+
+            mt = int(st.st_mtime)
+            self.stat_local(v, st)
+
+            # Reuse hash of same inode/size/mtime seen before, if any
+            # (i.e. the file is unchanged, renamed, moved, or hardlinked):
+            if not self.options.force_hash:
+                cached = self.hash_cache.get(st, fname)
+                if cached:
+                    v.hash_local  = cached
+                    v.size_local  = st.st_size
+                    v.mtime_local = mt
+
+                    if self.options.verbosity > 2: # VERY verbose!
+                        print('[SKIP]: {0}'.format(fitit(fname)))
+                    continue
+
+            time_differ = False
+            
+            # Get file mtime:
+            try:
+                rmt = v.mtime_read
+                #rmt = long(float(rmt))
+                rmt = float(rmt)
+                
+                if rmt - mt != 0:
+                    time_differ = True
+            except:
+                time_differ = True
+
+            # Without a hash cache to rely on (first run), trust mtime:
+            if self.hash_cache.found or self.options.force_hash or time_differ:
+                # Queue it, to be hashed in parallel afterwards:
+                pending.append((fname, st))
+            else:
+                # Skip, because it's the same file (relying on mtime here):
+                v.hash_local  = v.hash_read
+                v.size_local  = v.size_read
+                v.mtime_local = v.mtime_read
+                self.hash_cache.set(st, fname, v.hash_read)
+
+                if self.options.verbosity > 2: # VERY verbose!
+                    print('[SKIP]: {0}'.format(fitit(fname)))
+
+        # Calc hashes of all new/changed files:
+        self.hash_files(pending)
+
+    def stat_local(self, v, st):
+        """Save inode and mtime (in ns) of Fileitem "v" from stat result "st", and
+        flag it as DIRTY if they changed since last run."""
+
+        inode = state.inode_of(st)
+        if inode != v.inode or st.st_mtime_ns != v.mtime_ns:
+            v.flags |= DIRTY
+            v.inode = inode
+            v.mtime_ns = st.st_mtime_ns
+
+    def hash_files(self, pending):
+        """Calc hashes of files in "pending" (list of (name, stat) tuples) with a
+        pool of worker threads (hashlib releases the GIL), and save data in the
+        corresponding Fileitems. Hardlinks to the same inode are hashed only once.
+        Files are read in the order they are laid out on disk, if the filesystem
+        tells us (or by inode number, otherwise), to avoid random reads."""
+
+        if not pending:
+            return
+
+        # Group names by inode:
+        groups = {}
+        for fname, st in pending:
+            groups.setdefault(HashCache.key(st), []).append((fname, st))
+        groups = list(groups.values())
+        groups.sort(key=self.disk_order(groups))
+
+        items = [ self.files[group[0][0]] for group in groups ]
+        t0 = time.time()
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            hashes = pool.map(Fileitem.get_hash, items)
+
+            for group, new_hash in zip(groups, hashes):
+                self.hashed += 1
+                self.hashed_bytes += group[0][1].st_size
+
+                for fname, st in group:
+                    if self.options.verbosity > 0:
+                        print('[MD5] {0}'.format(fitit(fname)))
+                    v = self.files[fname]
+                    v.hash_local = new_hash
+                    v.size_local = st.st_size
+                    v.mtime_local = int(st.st_mtime)
+                    self.hash_cache.set(st, fname, new_hash)
+
+        self.hashed_time += time.time() - t0
+
+        if self.options.verbosity > 0 or self.options.timing:
+            fmt = '[MD5] {0} files, {1} in {2:.1f} s ({3}/s)'
+            print(fmt.format(len(groups), bytes2size(self.hashed_bytes), self.hashed_time, self.hash_rate()))
+
+    def disk_order(self, groups):
+        """Return function giving sort key, by physical location on disk, of groups
+        of (name, stat) tuples in "groups". If the filesystem does not support FIEMAP,
+        sort by inode number."""
+
+        try:
+            first_extent(self.files[groups[0][0][0]].fullname())
+        except OSError:
+            return lambda group: (group[0][1].st_dev, group[0][1].st_ino)
+
+        def key(group):
+            fname, st = group[0]
+            try:
+                offset = first_extent(self.files[fname].fullname())
+            except OSError:
+                offset = 0
+            return (st.st_dev, offset, st.st_ino)
+
+        return key
+
+    def trust_dirs(self):
+        """Return True if unchanged dirs are to be skipped in walk()."""
+
+        return self.options.trust_dirs and not self.options.force_hash
+
+    def dir_token(self):
+        """Return what identifies the local state (and the exclusions in effect when
+        it was saved), so that a DirCache is only used along with the same state
+        it was saved with. Return None if no state was saved."""
+
+        token = self.state.token()
+        if token is None:
+            return None
 
-    def save(self, fn, local=True):
-        """Save hashes of current file list in file "fn" (either index.dat, or
-        the corresponding file in ~/.gipsync/)."""
+        return (token, tuple(self.cfg.conf['EXCLUDES']))
+
+    def hash_rate(self):
+        """Return hashing throughput so far, in human-friendly form."""
+
+        if self.hashed_time > 0:
+            return bytes2size(self.hashed_bytes/self.hashed_time)
+
+        return bytes2size(0)
+
+    def jobs(self):
+        """Return number of parallel workers to use."""
+
+        jobs = self.options.jobs
+        if not jobs or jobs < 1:
+            jobs = os.cpu_count() or 1
+
+        return jobs
+
+    def save(self, local=True):
+        """Save hashes of current file list, either to local state, or to remote
+        index (index.dat)."""
 
         if local:
-            # Then save locally (generally, to corresponding hash file in ~/.gipsync/).
+            # Then save locally (only files that changed since read):
+            rows = []
+            for lfn in self.files.names(LOCAL):
+                v = self.files[lfn]
+                if not v.flags & READ or v.flags & DIRTY or v.hash_local != v.hash_read or v.size_local != v.size_read:
+                    rows.append((lfn, v.hash_local, v.size_local, v.mtime_ns, v.inode))
+            gone = [ lfn for lfn in self.files.names(READ) if not self.files[lfn].flags & LOCAL ]
+            self.state.update(rows, gone)
 
-            with open(fn, 'w') as f:
-                for lfn in self.files_local:
-                    val = self.files[lfn]
-                    fmt = '{fn}|{v.hash_local}:{v.size_local}:{v.mtime_local}\n'
-                    string = fmt.format(fn=lfn, v=val)
-                    f.write(string)
+            # What is saved is what will be read next time:
+            for lfn, hash, size, mtime_ns, inode in rows:
+                v = self.files[lfn]
+                v.flags = (v.flags | READ) & ~DIRTY
+                v.hash_read = hash
+                v.size_read = size
+                v.mtime_read = v.mtime_local
+            for lfn in gone:
+                self.files[lfn].flags &= ~READ
+
+            # Digests of local dirs, calculated again only if some file changed:
+            self.local_dirs = self.state.dir_digests()
+            if self.local_dirs is None:
+                digests = index.DirDigests()
+                for lfn in sorted(self.files.names(LOCAL)):
+                    v = self.files[lfn]
+                    digests.add(lfn, v.hash_local, v.size_local, v.mtime_local)
+                self.local_dirs = digests.digests()
+                self.state.save_dir_digests(self.local_dirs)
+
+            # Save hash cache (and dir cache) along:
+            self.hash_cache.save()
+            if self.trust_dirs():
+                self.dir_cache.save(self.dir_token())
 
         else:
             # Then save to remote repo, after GPGing it.
 
-            # Save copy to local tmp file:
-            tfn = '{0}/{1}'.format(self.tmpdir, fn)
-            string = ''
-
-            for lfn in self.files_remote:
+            entries = []
+            for lfn in self.files.names(REMOTE):
                 v = self.files[lfn]
-                fmt = '{0}|{1.hash_remote}:{1.size_remote}:{1.mtime_remote}\n'
-                string += fmt.format(lfn, v)
-            with open(tfn,'w') as f:
-                f.write(string)
-
-            # GPG temporary file tfn:
-            cmnd = '{0.gpgcom} -o "{0.tmpdir}/{1}.gpg" '.format(self, fn)
-            for recipient in self.cfg.prefs['RECIPIENTS']:
-                cmnd += ' -r {0} '.format(recipient)
-            cmnd += ' -e {0} '.format(tfn)
-            #fmt = '{0.gpgcom} -r {0.cfg.prefs[RECIPIENT]} -o "{0.tmpdir}/{1}.gpg" -e "{2}"'
-            #cmnd = fmt.format(self, fn, tfn)
-            self.doit(cmnd,2)
+                entries.append((lfn, v.hash_remote, v.size_remote, v.mtime_remote))
+            entries.sort()
+
+            # Repack what is left of packs mostly dead, and forget chunks no
+            # longer used, after uploading:
+            old = []
+            dead = []
+            if self.options.up:
+                alive = set([ entry[1] for entry in entries ])
+                old = self.gc_packs(alive)
+                dead = sorted(self.chunkmap.keep(alive))
 
-            # Upload to remote:
-            cmnd1 = '{0} -q '.format(self.rsync)
-            cmnd2 = ' "{0}.gpg" '.format(tfn)
-            cmnd3 = ' "{0}/{1}/{2}.gpg"'.format(self.cfg.prefs['REMOTE'], self.cfg.conf['REPODIR'], fn)
+            self.send_index(entries)
 
-            if self.options.verbosity > 1:
-                print('\n' + cmnd1)
-                print(' '  + cmnd2)
-                print(' '  + cmnd3 + '\n')
+            # Remove packs (and chunks) no longer needed, once no longer in catalog:
+            if old:
+                self.remove_remote(old, dir='packs')
+            if dead:
+                self.remove_remote(dead, dir='chunks')
 
-            cmnd = cmnd1 + cmnd2 + cmnd3
-            self.doit(cmnd,666)
+            # Record in local state which files were synced with it:
+            if self.options.up:
+                self.state.synced(self.diff.local + self.diff.newlocal, self.generation)
+            else:
+                self.state.synced(self.diff.placed, self.generation)
 
-    def read_remote(self):
-        """Read remote repo metadata."""
+    def send_index(self, entries):
+        """Save "entries" (sorted by name) as remote index, GPG it, and upload it to
+        remote repo: as a single index.dat file, or split into shards (see
+        send_shards()), if so configured. A new generation of it is published
+        afterwards (see get_index())."""
+
+        # Invalidate copies of remote index (here and elsewhere) while it changes:
+        self.forget_generation()
+        self.new_generation()
+
+        digests = index.DirDigests()
+        entries = digests.feed(entries)
+
+        if self.index_shards:
+            self.send_shards(entries)
+        else:
+            self.send_single(entries)
+
+        if self.catalog.changed:
+            self.send_catalog(self.catalog, 'packs.dat')
+        if self.chunkmap.changed:
+            self.send_catalog(self.chunkmap, 'chunks.dat')
+
+        # Then publish a new generation, and record that our copy is that one:
+        self.new_generation()
+        self.stamp = self.index_stamp()
+        self.save_generation()
+
+        self.remote_dirs = digests.digests()
+        self.save_dirs()
+
+    def send_single(self, entries):
+        """Save "entries" (sorted by name) as remote index.dat, GPG it, and upload
+        it to remote repo. Its plaintext is kept in local cache."""
+
+        # Save copy to local tmp file:
+        tfn = os.path.join(self.tmpdir, 'index.dat')
+        index.write_index(tfn, entries, self.algo, binary=self.binary_index, presorted=True)
+
+        # GPG temporary file tfn:
+        self.gpg_encrypt(tfn, '{0}.gpg'.format(tfn))
+
+        # Upload to remote:
+        cmnd1 = '{0} -q '.format(self.rsync)
+        cmnd2 = ' "{0}.gpg" '.format(tfn)
+        cmnd3 = ' "{0}/{1}/index.dat.gpg"'.format(self.cfg.prefs['REMOTE'], self.cfg.conf['REPODIR'])
+
+        if self.options.verbosity > 1:
+            print('\n' + cmnd1)
+            print(' '  + cmnd2)
+            print(' '  + cmnd3 + '\n')
+
+        cmnd = cmnd1 + cmnd2 + cmnd3
+        self.doit(cmnd,666)
+        os.replace(tfn, os.path.join(self.index_cache, 'index.dat'))
+
+        # Remove shards, if remote index was sharded so far:
+        if self.manifest is not None:
+            self.remove_remote(['manifest'] + shard_blobs(self.manifest), dir='index')
+            self.manifest = None
+
+    def send_catalog(self, catalog, name):
+        """Save "catalog" (of packs, or map of chunks) as remote file "name" (e.g.
+        packs.dat), GPG it, and upload it to remote repo. Its plaintext is kept in
+        local cache."""
+
+        fn = os.path.join(self.tmpdir, name)
+        catalog.write(fn)
+        self.gpg_encrypt(fn, fn + '.gpg')
+
+        cmnd = '{0} -q "{1}.gpg" "{2}/{3}/{4}.gpg"'.format(self.rsync, fn, self.cfg.prefs['REMOTE'], self.cfg.conf['REPODIR'], name)
+        self.doit(cmnd, 2)
+        os.replace(fn, os.path.join(self.index_cache, name))
+        catalog.changed = False
+
+    def send_shards(self, entries):
+        """Save "entries" (sorted by name) as remote index split into shards (see
+        INDEX_SHARDS), GPG and upload the shards that changed, and then a manifest
+        with the digests of all of them. Shards no longer listed in it are then
+        removed from remote repo. Shards are named after their number and digest,
+        and their plaintext kept in a local cache, to avoid downloading them again
+        next time (see get_index())."""
+
+        w = index.ShardWriter(os.path.join(self.tmpdir, 'shards'), self.index_shards, self.algo, self.binary_index)
+        for entry in entries:
+            w.write(*entry)
+        files = w.close()
+
+        # GPG changed shards:
+        old = shard_blobs(self.manifest)
+        digests = {}
+        new = []
+        for i, fn in sorted(files.items()):
+            digests[str(i)] = hashof(fn)
+            blob = '{0}.{1}'.format(i, digests[str(i)])
+            if not blob in old:
+                if self.options.verbosity > 0:
+                    print('[IDX] {0}'.format(blob))
+                self.gpg_encrypt(fn, '{0}/index/{1}.gpg'.format(self.tmpdir, blob))
+                new.append(blob)
+            os.replace(fn, os.path.join(self.index_cache, blob))
+
+        manifest = { 'hash': self.algo, 'shards': self.index_shards, 'digests': digests }
+        mfn = os.path.join(self.tmpdir, 'index', 'manifest')
+        with open(mfn, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        self.gpg_encrypt(mfn, mfn + '.gpg')
+
+        # Upload changed shards first, then manifest:
+        if new:
+            self.transfer(new, dir='index')
+        self.transfer(['manifest'], dir='index')
+        os.replace(mfn, os.path.join(self.index_cache, 'manifest'))
+
+        # Remove stale shards (or whole index.dat, if it was not sharded so far):
+        blobs = shard_blobs(manifest)
+        if self.manifest is None:
+            self.remove_remote(['index.dat'], dir='.')
+        else:
+            self.remove_remote([ blob for blob in old if not blob in blobs ], dir='index')
+        self.manifest = manifest
+
+    def gpg_encrypt(self, src, dst, compress=True):
+        """GPG file "src" into file "dst", for all recipients. See encrypt_command()
+        for "compress"."""
+
+        self.doit(self.encrypt_command(src, dst, compress), 2)
+
+    def encrypt_command(self, src, dst='-', compress=True):
+        """Return command to GPG file "src" into file "dst" (stdout, by default),
+        for all recipients. Contents are compressed (as GPG does by default) if
+        "compress", not compressed if False, and compressed only if worth it if
+        None (see compressible())."""
+
+        if compress is None:
+            compress = self.compressible(src)
+
+        cmnd = '{0.gpgcom} -o "{1}" '.format(self, dst)
+        if not compress:
+            cmnd += ' -z 0 '
+        for recipient in self.cfg.prefs['RECIPIENTS']:
+            cmnd += ' -r {0} '.format(recipient)
+        cmnd += ' -e "{0}" '.format(src)
+
+        return cmnd
+
+    def compressible(self, fn):
+        """Return True if local file "fn" is worth compressing when GPG-ing it. As
+        per COMPRESS in repo config, it is always, never, or (by default, "auto")
+        unless its extension is one of self.incompressible, or a sample of its
+        first bytes does not compress (files smaller than COMPRESS_MIN are not
+        sampled). Files not to be compressed are counted in self.uncompressed."""
+
+        if self.compress == 'auto':
+            ext = os.path.splitext(fn)[1].lower()
+            if ext in self.incompressible:
+                compress = False
+            else:
+                try:
+                    with open(fn, 'rb') as f:
+                        sample = f.read(COMPRESS_SAMPLE)
+                except OSError:
+                    return True # leave it to gpg to complain
+                compress = len(sample) < COMPRESS_MIN or len(zlib.compress(sample, 1)) < COMPRESS_RATIO*len(sample)
+        else:
+            compress = self.compress == 'always'
+
+        if not compress:
+            size = os.path.getsize(fn)
+            with self.lock:
+                self.uncompressed[0] += 1
+                self.uncompressed[1] += size
+
+        return compress
+
+    def say_uncompressed(self):
+        """Print how many files were GPG-ed without compression, and an estimate
+        of the CPU time saved (what compressing as much random data takes)."""
+
+        n, size = self.uncompressed
+        if not n:
+            return
+
+        sample = os.urandom(1024*1024)
+        t0 = time.time()
+        zlib.compress(sample, 6) # level used by gpg by default
+        saved = (time.time() - t0) * size / len(sample)
+
+        print('\n{0:30}: {1} ({2})'.format('Files not compressed', n, bytes2size(size)))
+        print('{0:30}: {1:.1f} s'.format('CPU time saved (estimated)', saved))
+
+    def remote_command(self, command):
+        """Return args to run shell command "command" in the remote host, with the
+        SSH command in global config (plain "ssh" by default). If REMOTE has no host
+        part (e.g. it is a mounted dir), the command is run locally instead."""
+
+        host, sep, path = self.cfg.prefs['REMOTE'].partition(':')
+        if not sep:
+            return ['sh', '-c', command]
+
+        return shlex.split(self.cfg.prefs.get('SSH', 'ssh')) + [host, command]
+
+    def remote_dir(self, dir='data'):
+        """Return path of subdir "dir" of remote repo, as seen from the remote host
+        (see remote_command())."""
+
+        host, sep, path = self.cfg.prefs['REMOTE'].partition(':')
+        if not sep:
+            path = host
+
+        return os.path.join(path, self.cfg.conf['REPODIR'], dir)
+
+    def decrypt_index(self):
+        """Un-GPG the downloaded remote index, and return the list of (local) paths
+        of its plaintext: that of index.dat, or those of all its shards, if sharded
+        (see send_shards()). The catalog of packs and the map of chunks are read too
+        (see read_catalog() and read_chunkmap())."""
+
+        self.read_catalog()
+        self.read_chunkmap()
+
+        if self.manifest is not None:
+            return self.decrypt_shards()
+
+        lfn = os.path.join(self.index_cache, 'index.dat')
+        if self.index_reused:
+            return [ lfn ]
 
         fn = 'index.dat'
         cmnd = '{0.gpgcom} -o "{0.tmpdir}/{1}" -d "{0.tmpdir}/{1}.gpg"'.format(self, fn)
@@ -616,70 +1304,239 @@ class Repositories(object):
             print('\n'+cmnd)
         
         self.doit(cmnd)
-        conf = os.path.join(self.tmpdir, fn)
 
-        dict = conf2dic(conf,separator='|')
+        # Keep copy, in case remote index does not change until next time:
+        os.replace(os.path.join(self.tmpdir, fn), lfn)
+        self.save_generation()
 
-        for k,v in dict.items():
-            av = v.split(':')
-  
-            if len(av) < 2:
-                msj = 'The length of dictionary entry "{0}|{1}" is too short!'.format(k, v)
-                sys.exit(msj)
-            if not k in self.files:
-                self.files[k] = Fileitem(k, repos=self)
-            if not k in self.files_remote:
-                self.files_remote[k] = True
-            self.files[k].hash_remote  = av[0]
-            self.files[k].size_remote  = float(av[1])
-            self.files[k].mtime_remote = float(av[2])
+        return [ lfn ]
 
-    def compare(self):
-        """Compare local and remote repositories."""
+    def decrypt_shards(self):
+        """Un-GPG the shards of remote index not in local cache, and return the
+        list of paths of all of them, in local cache."""
 
-        # Check in single loop:
-        for k,v in self.files.items():
-            if v.hash_local: # then file exists locally
-                if v.hash_remote: # then file exists remotelly too
-                    if v.hash_local != v.hash_remote:
-                        # Then files differ, use mtime to decice which
-                        # one to keep (newest):
-                        lmt = v.mtime_local
-                        rmt = v.mtime_remote
-
-                        if lmt < rmt:
-                            self.diff.newremote.append(k)
-                            self.diff.newremote_hash[v.hash_remote] = k
-                            if self.options.verbosity > 0:
-                                fmt = '\ndiff: local [{0}] -- remote [\033[32m{1}\033[0m] {2}'
-                                print(fmt.format(e2d(lmt), e2d(rmt), k))
-
-                        elif lmt > rmt or (self.options.up and self.options.force_hash):
-                            self.diff.newlocal.append(k)
-                            self.diff.newlocal_hash[v.hash_local] = k
-                            if self.options.verbosity > 0:
-                                fmt = '\ndiff: local [\033[32m{0}\033[0m] -- remote [{1}] {2}'
-                                print(fmt.format(e2d(lmt), e2d(rmt), k))
-
-                        else:
-                            fmt = '\033[33m[WARN]\033[0m "{0}" differs, but has same mtime.'
-                            print(fmt.format(k))
-                            if self.options.update_equals:
-                                if self.options.up:
-                                    self.diff.newlocal.append(k)
-                                    self.diff.newlocal_hash[v.hash_local] = k
-                                else:
-                                    self.diff.newremote.append(k)
-                                    self.diff.newremote_hash[v.hash_remote] = k
-
-                else:  # then file exists only locally
-                    self.diff.local.append(k)
-                    self.diff.local_hash[v.hash_local] = k
-
-            elif v.hash_remote: # then file exists only remotely
-                if not find_exc(k, self.cfg.conf['EXCLUDES']): # ignore files matching some rule
-                    self.diff.remote.append(k)
-                    self.diff.remote_hash[v.hash_remote] = k
+        files = []
+        for blob in shard_blobs(self.manifest):
+            fn = os.path.join(self.index_cache, blob)
+            if not os.path.isfile(fn):
+                cmnd = '{0} -o "{1}.tmp" -d "{2}/index/{3}.gpg"'.format(self.gpgcom, fn, self.tmpdir, blob)
+                self.doit(cmnd)
+
+                if '{0}.{1}'.format(blob.split('.')[0], hashof(fn + '.tmp')) != blob:
+                    sys.exit('\033[31m[NOOK]\033[0m Shard {0} of remote index is corrupt'.format(blob))
+                os.replace(fn + '.tmp', fn)
+            files.append(fn)
+
+        # Keep manifest too, in case remote index does not change until next time:
+        if not self.index_reused:
+            os.replace(os.path.join(self.tmpdir, 'index', 'manifest'), os.path.join(self.index_cache, 'manifest'))
+            self.save_generation()
+
+        return files
+
+    def decrypt_catalog(self, name):
+        """Un-GPG the downloaded remote file "name" (e.g. packs.dat) into local cache
+        (or use the copy there, if remote index unchanged). Return its path, or None
+        if remote repo has no such file."""
+
+        lfn = os.path.join(self.index_cache, name)
+        if not self.index_reused:
+            fn = os.path.join(self.tmpdir, name)
+            if os.path.isfile(fn + '.gpg'):
+                self.doit('{0} -o "{1}" -d "{1}.gpg"'.format(self.gpgcom, fn))
+                os.replace(fn, lfn)
+            elif os.path.isfile(lfn):
+                os.unlink(lfn)
+
+        if os.path.isfile(lfn):
+            return lfn
+
+        return None
+
+    def read_catalog(self):
+        """Read the catalog of packs of remote repo (see decrypt_catalog()) into
+        self.catalog, along with the packs uploaded in a previous interrupted run
+        (see send_pack()). Remote repos with no packs have no catalog."""
+
+        lfn = self.decrypt_catalog('packs.dat')
+        self.catalog = packs.Catalog(self.algo)
+        if lfn:
+            self.catalog.read(lfn)
+
+        # Packs uploaded in a previous interrupted run:
+        members = {} # dict of pack -> list of (hash, offset, size)
+        for value in self.journal.values('packed'):
+            hash, pack, offset, size = value.split(':')
+            members.setdefault(pack, []).append((hash, int(offset), int(size)))
+        for value in self.journal.values('pack'):
+            pack, size = value.split(':')
+            self.catalog.add(pack, int(size), members.get(pack, []))
+
+    def read_chunkmap(self):
+        """Read the map of chunks of remote repo (see decrypt_catalog()) into
+        self.chunkmap, along with the files chunked in a previous interrupted run
+        (see split_file()). Remote repos with no chunked files have no map."""
+
+        lfn = self.decrypt_catalog('chunks.dat')
+        self.chunkmap = cdc.ChunkMap(self.algo)
+        if lfn:
+            self.chunkmap.read(lfn)
+
+        for value in self.journal.values('chunked'):
+            hash, _, members = value.partition('|')
+            self.chunkmap.add(hash, cdc.decode(members))
+
+    def prune_index_cache(self):
+        """Remove from local cache of remote index whatever is not part of it."""
+
+        keep = set(shard_blobs(self.manifest))
+        keep.add('generation')
+        keep.add('packs.dat')
+        keep.add('chunks.dat')
+        keep.add('dirs.dat')
+        if self.manifest is None:
+            keep.add('index.dat')
+        else:
+            keep.add('manifest')
+
+        for fn in os.listdir(self.index_cache):
+            if not fn in keep:
+                os.unlink(os.path.join(self.index_cache, fn))
+
+    def new_generation(self):
+        """Upload a new (random) generation id of remote index to remote repo, as
+        index.gen (see get_index())."""
+
+        self.generation = os.urandom(16).hex()
+
+        gfn = os.path.join(self.tmpdir, 'index.gen')
+        with open(gfn, 'w') as f:
+            f.write(self.generation + '\n')
+
+        cmnd = '{0.rsync} -q "{1}" "{0.cfg.prefs[REMOTE]}/{0.cfg.conf[REPODIR]}/index.gen"'.format(self, gfn)
+        self.doit(cmnd,2)
+
+    def save_generation(self):
+        """Record that local cache of remote index holds generation self.generation
+        of it, with stamp self.stamp (after removing from it what is not part of it)."""
+
+        self.prune_index_cache()
+
+        if self.generation is not None and self.stamp is not None:
+            fn = os.path.join(self.index_cache, 'generation')
+            with open(fn + '.tmp', 'w') as f:
+                f.write(self.generation + '\n')
+                f.write(self.stamp)
+            os.replace(fn + '.tmp', fn)
+
+    def forget_generation(self):
+        """Record that local cache of remote index is not to be trusted."""
+
+        fn = os.path.join(self.index_cache, 'generation')
+        if os.path.isfile(fn):
+            os.unlink(fn)
+
+    def cached_generation(self):
+        """Return generation of remote index held in local cache, and its stamp (see
+        index_stamp()), as a tuple, or (None, None)."""
+
+        fn = os.path.join(self.index_cache, 'generation')
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                generation, _, stamp = f.read().partition('\n')
+            return generation, stamp
+
+        return None, None
+
+    def save_dirs(self):
+        """Save digests of dirs of remote index (self.remote_dirs) in local cache of
+        it, along with the generation of the remote index they are of."""
+
+        if self.generation is not None:
+            fn = os.path.join(self.index_cache, 'dirs.dat')
+            index.write_digests(fn, self.remote_dirs, generation=self.generation)
+
+    def cached_dirs(self):
+        """Return digests of dirs of remote index saved in local cache of it, if
+        reused (see get_index()) and of the same generation, or None."""
+
+        fn = os.path.join(self.index_cache, 'dirs.dat')
+        if self.index_reused and os.path.isfile(fn):
+            header, digests = index.read_digests(fn)
+            if header.get('generation') == self.generation:
+                return digests
+
+        return None
+
+    def index_stamp(self):
+        """Return the size and mtime of the remote index file(s) (index.dat.gpg, or
+        index/manifest.gpg), as listed by rsync, or None if not found. Older
+        versions of gipsync upload the index without changing index.gen, so the
+        generation alone does not tell whether the index changed."""
+
+        remote = '{0.prefs[REMOTE]}/{0.conf[REPODIR]}'.format(self.cfg)
+        cmnd = '{0} --list-only "{1}/index.dat.gpg" "{1}/index/manifest.gpg"'.format(self.rsync, remote)
+
+        if self.options.verbosity > 1:
+            print(cmnd)
+
+        s = sp.Popen(cmnd, stdout=sp.PIPE, stderr=sp.DEVNULL, shell=True)
+        out = s.communicate()[0].decode('utf-8', 'surrogateescape')
+
+        # Keep size, date, time and name of each file (not the permissions):
+        lines = sorted([ ' '.join(line.split()[1:]) for line in out.splitlines() if line.strip() ])
+        if not lines:
+            return None
+
+        return ''.join([ line + '\n' for line in lines ])
+
+    def read_remote(self):
+        """Read remote repo metadata, and the digests of its dirs (calculated
+        only if not in local cache, see cached_dirs())."""
+
+        self.remote_dirs = self.cached_dirs()
+        digests = None
+        if self.remote_dirs is None:
+            digests = index.DirDigests()
+
+        n = 0
+        for fn in self.decrypt_index():
+            algo, entries = index.read_index(fn)
+            if digests:
+                entries = digests.feed(entries)
+
+            for k, hash, size, mtime in entries:
+                v = self.files.add(k)
+                v.flags |= REMOTE
+                v.hash_remote  = hash
+                v.size_remote  = size
+                v.mtime_remote = mtime
+                n += 1
+
+            # Hash algorithm used in remote index (irrelevant if there are no entries):
+            if n:
+                self.remote_algo = algo
+
+        if digests:
+            self.remote_dirs = digests.digests()
+            self.save_dirs()
+
+    def compare(self):
+        """Compare local and remote repositories, skipping whole dirs whose
+        digests are the same in both (see differing_dirs())."""
+
+        dirs = self.differing_dirs()
+        if dirs is not None and self.options.verbosity > 0:
+            fmt = '[INFO] Comparing files in {0} of {1} dirs'
+            print(fmt.format(len(dirs), len(set(self.local_dirs) | set(self.remote_dirs))))
+
+        # Use NumPy if available (and if some dir differs at all):
+        if dirs is not None and not dirs:
+            pass
+        elif np is not None:
+            self.compare_columns(dirs)
+        else:
+            self.compare_files(dirs)
 
         # Print summaries if enough verbosity:
         if self.options.verbosity > 1:
@@ -698,6 +1555,158 @@ class Repositories(object):
             for k,v in self.diff.newremote_hash.items():
                 print(k,v)
 
+    def differing_dirs(self):
+        """Return set of dirs whose digests (see index.DirDigests) differ locally
+        and remotely, going top-down from the top dir, and skipping the subdirs of
+        dirs whose digests match. Return None if the digests are not known."""
+
+        local, remote = self.local_dirs, self.remote_dirs
+        if local is None or remote is None:
+            return None
+
+        subdirs = {}
+        for dir in set(local) | set(remote):
+            if dir:
+                subdirs.setdefault(dir.rpartition('/')[0], []).append(dir)
+
+        dirs = set()
+        todo = ['']
+        while todo:
+            dir = todo.pop()
+            if local.get(dir) != remote.get(dir):
+                dirs.add(dir)
+                todo.extend(subdirs.get(dir, ()))
+
+        return dirs
+
+    def compare_columns(self, dirs=None):
+        """Compare local and remote repositories, working on whole columns of
+        the FileTable at once, with NumPy. Same as compare_files()."""
+
+        t = self.files
+        names = list(t.rows) # rows are in insertion order
+
+        # Columns (no copies made):
+        hl = np.frombuffer(t.hash_local, dtype='S{0}'.format(DSIZE))
+        hr = np.frombuffer(t.hash_remote, dtype='S{0}'.format(DSIZE))
+        ml = np.frombuffer(t.mtime_local, dtype=np.float64)
+        mr = np.frombuffer(t.mtime_remote, dtype=np.float64)
+
+        # Classify (an all-zero hash means there is no such file):
+        is_local = hl != b''
+        is_remote = hr != b''
+
+        if dirs is not None:
+            inside = np.fromiter(( name.rpartition('/')[0] in dirs for name in names ), dtype=bool, count=len(names))
+            is_local &= inside
+            is_remote &= inside
+
+        differ = is_local & is_remote & (hl != hr)
+        newremote = differ & (ml < mr)
+        if self.options.up and self.options.force_hash:
+            newlocal = differ & ~newremote
+        else:
+            newlocal = differ & (ml > mr)
+        same_mtime = differ & ~newremote & ~newlocal
+
+        only_local = is_local & ~is_remote
+        only_remote = is_remote & ~is_local
+
+        # Print info (in row order, as compare_files() does):
+        shown = same_mtime
+        if self.options.verbosity > 0:
+            shown = newremote | newlocal | same_mtime
+        for i in np.flatnonzero(shown):
+            if newremote[i]:
+                fmt = '\ndiff: local [{0}] -- remote [\033[32m{1}\033[0m] {2}'
+                print(fmt.format(e2d(ml[i]), e2d(mr[i]), names[i]))
+            elif newlocal[i]:
+                fmt = '\ndiff: local [\033[32m{0}\033[0m] -- remote [{1}] {2}'
+                print(fmt.format(e2d(ml[i]), e2d(mr[i]), names[i]))
+            else:
+                fmt = '\033[33m[WARN]\033[0m "{0}" differs, but has same mtime.'
+                print(fmt.format(names[i]))
+
+        if self.options.update_equals:
+            if self.options.up:
+                newlocal |= same_mtime
+            else:
+                newremote |= same_mtime
+
+        # Fill in diff:
+        def fill(mask, lista, hashes, column):
+            rows = np.flatnonzero(mask)
+            if lista is self.diff.remote: # ignore files matching some rule
+                rows = [ i for i in rows if not self.excluder.match(names[i]) ]
+            for i in rows:
+                k = names[i]
+                lista.append(k)
+                hashes[column[DSIZE*i:DSIZE*(i+1)].hex()] = k
+
+        fill(newremote, self.diff.newremote, self.diff.newremote_hash, t.hash_remote)
+        fill(newlocal, self.diff.newlocal, self.diff.newlocal_hash, t.hash_local)
+        fill(only_local, self.diff.local, self.diff.local_hash, t.hash_local)
+        fill(only_remote, self.diff.remote, self.diff.remote_hash, t.hash_remote)
+
+    def compare_files(self, dirs=None):
+        """Compare local and remote repositories, file by file (only the files
+        right in "dirs", if given)."""
+
+        # Check in single loop:
+        for k,v in self.files.items():
+            if dirs is not None and not k.rpartition('/')[0] in dirs:
+                continue
+
+            which = self.classify(k, v.hash_local, v.mtime_local, v.hash_remote, v.mtime_remote)
+
+            if which in ('local', 'newlocal'):
+                getattr(self.diff, which).append(k)
+                getattr(self.diff, which + '_hash')[v.hash_local] = k
+
+            elif which:
+                getattr(self.diff, which).append(k)
+                getattr(self.diff, which + '_hash')[v.hash_remote] = k
+
+    def classify(self, k, hl, ml, hr, mr):
+        """Return which list of the RepoDiff ("local", "remote", "newlocal" or
+        "newremote") file "k" belongs to, given its local hash and mtime, and its
+        remote hash and mtime (hashes are None for missing files). Return None if
+        it needs no action."""
+
+        if hl: # then file exists locally
+            if not hr:  # then file exists only locally
+                return 'local'
+
+            if hl == hr:
+                return None
+
+            # Then files differ, use mtime to decice which
+            # one to keep (newest):
+            if ml < mr:
+                if self.options.verbosity > 0:
+                    fmt = '\ndiff: local [{0}] -- remote [\033[32m{1}\033[0m] {2}'
+                    print(fmt.format(e2d(ml), e2d(mr), k))
+                return 'newremote'
+
+            if ml > mr or (self.options.up and self.options.force_hash):
+                if self.options.verbosity > 0:
+                    fmt = '\ndiff: local [\033[32m{0}\033[0m] -- remote [{1}] {2}'
+                    print(fmt.format(e2d(ml), e2d(mr), k))
+                return 'newlocal'
+
+            fmt = '\033[33m[WARN]\033[0m "{0}" differs, but has same mtime.'
+            print(fmt.format(k))
+            if self.options.update_equals:
+                if self.options.up:
+                    return 'newlocal'
+                return 'newremote'
+
+        elif hr: # then file exists only remotely
+            if not self.excluder.match(k): # ignore files matching some rule
+                return 'remote'
+
+        return None
+
     def upload(self):
         """Upload files from local to remote."""
 
@@ -712,28 +1721,30 @@ class Repositories(object):
 
         # In this case, we need to upload stuff:
         if self.really_do and file_list:
-            # First encrypt files to tmp dir:
-            self.encrypt(file_list, self.options.size_control)
-
-            # Upload only if --size-control option not given:
-            if not self.options.size_control:
-                # Build list of files to upload from tmpdir to remote repo:
-                tmpfile = '{0}/filelist.txt'.format(self.tmpdir)
-                with open(tmpfile,'w') as f:
-                    for h in self.diff.local_hash:
-                        f.write(h+'.gpg\n')
-
-                    for h in self.diff.newlocal_hash:
-                        f.write(h+'.gpg\n')
-
-                # Finally, upload all of them from tmpdir to remote repo:
-                fmt  = '{0.rsync} -vh --progress {0.tmpdir}/data/ --files-from={1} '
-                fmt += ' {0.cfg.prefs[REMOTE]}/{0.cfg.conf[REPODIR]}/data/'
-                cmnd = fmt.format(self,tmpfile)
+            # With --size-control, GPG/upload nothing (just log it):
+            if self.options.size_control:
+                self.encrypt(file_list, True)
+
+            # With --pipe, GPG them straight into remote repo:
+            elif self.options.pipe:
+                self.encrypt(file_list, False)
+
+            else:
+                # Upload all of them (but the ones uploaded in a previous
+                # interrupted run) from tmpdir to remote repo, as they are GPG-ed
+                # (starting with the ones GPG-ed in a previous interrupted run):
+                hashes = list(self.diff.local_hash) + list(self.diff.newlocal_hash)
+                uploads = TransferQueue(self)
                 try:
-                    self.doit(cmnd,2)
-                    os.unlink(tmpfile)
-                except:
+                    for h in hashes:
+                        if self.journal.has('gpg', h) and not self.journal.has('up', h):
+                            uploads.put(h, self.blob_size(h))
+                    self.encrypt(file_list, False, done=uploads.put)
+                except BaseException:
+                    if not uploads.close():
+                        return False
+                    raise
+                if not uploads.close():
                     return False
 
             # Log changes:
@@ -743,69 +1754,614 @@ class Repositories(object):
                 v.size_remote  = v.size_local
                 v.mtime_remote = v.mtime_local
 
+            self.say_uncompressed()
+
             return True
 
         # If we reach this point, return False:
         return False
+
+    def blob_size(self, hash):
+        """Return size of GPG file of hash "hash" in tmpdir (0 if not there)."""
+
+        try:
+            return os.path.getsize('{0}/data/{1}.gpg'.format(self.tmpdir, hash))
+        except OSError:
+            return 0
+
+    def staged_size(self, size):
+        """Return room in tmpdir needed to download (and un-GPG) a file of "size"
+        bytes: twice as much, if un-GPG-ed into tmpdir too (see decrypt())."""
+
+        if size < self.STREAM_SIZE:
+            return 2*size
+
+        return size
+
+    def chunk_bytes(self):
+        """Return bytes to download at a time (at most), so that a chunk can be
+        downloaded while the previous one is being put into place, within
+        self.budget."""
+
+        if self.budget.total is None:
+            return self.CHUNK_BYTES
+
+        return min(self.CHUNK_BYTES, self.budget.total // 2)
+
+    def too_big(self, size):
+        """Return True if "size" bytes do not fit in self.budget at all, so that
+        the file is to be piped (see pipe_up() and pipe_down()) instead of staged
+        in tmpdir."""
+
+        return self.budget.total is not None and size > self.budget.total
+
+    def transfer(self, hashes, up=True, dir='data', fatal_errors=True):
+        """Upload the GPG files of given hashes from tmpdir to remote repo (or download
+        them from remote repo to tmpdir, if not "up"), with a single rsync. Files are
+        in subdir "dir" of both. See doit() for "fatal_errors"."""
+
+        # Build list of files to transfer:
+        tmpfile = '{0}/filelist.{1}.txt'.format(self.tmpdir, threading.get_ident()) # one per thread
+        with open(tmpfile,'w') as f:
+            for h in hashes:
+                f.write(h+'.gpg\n')
+
+        if up:
+            fmt  = '{0.rsync} -vh --progress {0.tmpdir}/{2}/ --files-from={1} '
+            fmt += ' {0.cfg.prefs[REMOTE]}/{0.cfg.conf[REPODIR]}/{2}/'
+        else:
+            fmt = '{0.rsync} -vh --progress {0.cfg.prefs[REMOTE]}/{0.cfg.conf[REPODIR]}/{2}/ --files-from={1}'
+            fmt += ' {0.tmpdir}/{2}/'
+        self.doit(fmt.format(self,tmpfile,dir), 2, fatal_errors)
+        os.unlink(tmpfile)
     
-    def encrypt(self, file_list, control):
+    def encrypt(self, file_list, control, done=None):
+        """GPG files in "file_list" into tmpdir, unless "control" (see --size-control).
+        See gpg_files() for "done"."""
+
         if file_list:
             print('\n')
             
+        todo = []
+        small = []
+        big = []
+        piped = []
         for name in file_list:
             v = self.files[name]
             
             # Log it:
-            if not name in self.files_remote:
-                self.files_remote[name] = True
+            v.flags |= REMOTE
             # If --size-control, GPG nothing:
             if not control:
-                # GPG it:
-                fgpg  = '{0}.gpg'.format(v.hash_local)
-                lfile = '{0}/data/{1}'.format(self.tmpdir, fgpg)
-                
-                # Only GPG if not GPGed yet:
-                if not os.path.isfile(lfile):
+                if v.size_local < self.pack_files:
+                    small.append((name, v.hash_local))
+                elif self.chunk_files and v.size_local >= self.chunk_files:
+                    big.append((name, v.hash_local))
+                elif self.options.pipe or self.too_big(v.size_local):
+                    piped.append((name, v.hash_local))
+                else:
+                    todo.append((name, v.hash_local))
+
+        # Pack small files (see PACK_FILES), and chunk big ones (see CHUNK_FILES):
+        if small:
+            self.pack(small)
+        if big:
+            self.split(big)
+
+        if piped:
+            self.pipe_files(piped)
+        self.gpg_files(todo, done)
+
+    def pack(self, todo, writer=None):
+        """Pack the local files in "todo" (a list of (name, hash) tuples), GPG the
+        packs and upload them to remote repo, see send_pack(). Contents already in
+        some pack are skipped, and so are duplicates. Packs are written with
+        "writer" (a packs.PackWriter, see pack_writer()), which the caller must
+        close, if given."""
+
+        w = writer or self.pack_writer()
+
+        for name, hash in todo:
+            if hash in self.catalog or hash in w.hashes:
+                continue
+
+            with open(os.path.join(self.cfg.conf['LOCALDIR'], name), 'rb') as f:
+                w.add(hash, f.read())
+            if self.options.verbosity < 2:
+                print('\033[32m[PACK]\033[0m {0}'.format(fitit(name)))
+
+        if writer is None:
+            w.close()
+
+    def pack_writer(self):
+        """Return a packs.PackWriter for packs of self.pack_size bytes, in tmpdir,
+        sent to remote repo as they are complete (see send_pack())."""
+
+        return packs.PackWriter(os.path.join(self.tmpdir, 'packs'), self.pack_size, self.send_pack)
+
+    def send_pack(self, pack, fn, size, members):
+        """GPG pack "pack" (in file "fn", "size" bytes long, holding "members", a list
+        of (hash, offset, size) tuples), upload it to remote repo, and add it to the
+        catalog. It is logged in the journal, to resume interrupted runs (see
+        read_catalog())."""
+
+        self.gpg_encrypt(fn, fn + '.gpg', None)
+        os.unlink(fn)
+        self.transfer([pack], dir='packs')
+        os.unlink(fn + '.gpg')
+
+        for hash, offset, n in members:
+            self.journal.log('packed', '{0}:{1}:{2}:{3}'.format(hash, pack, offset, n))
+        self.journal.log('pack', '{0}:{1}'.format(pack, size))
+
+        self.catalog.add(pack, size, members)
+
+    def read_packs(self, hashes):
+        """Yield (hash, data) tuples with the contents of each of "hashes" (which must
+        be in the catalog), taken from the packs holding them: each pack is downloaded
+        and un-GPG-ed once. "data" is None if the pack is not in remote repo, and
+        False if it (or the contents in it) is corrupted."""
+
+        bypack = {} # dict of pack -> list of (offset, hash, size)
+        for hash in set(hashes):
+            pack, offset, size = self.catalog.get(hash)
+            bypack.setdefault(pack, []).append((offset, hash, size))
+
+        for pack, members in sorted(bypack.items()):
+            fn = os.path.join(self.tmpdir, 'packs', pack)
+            if not self.fetch('packs/{0}.gpg'.format(pack)):
+                for offset, hash, size in members:
+                    yield hash, None
+                continue
+
+            self.doit('{0} -o "{1}" -d "{1}.gpg"'.format(self.gpgcom, fn), 2, fatal_errors=False)
+            os.unlink(fn + '.gpg')
+            if not os.path.isfile(fn):
+                for offset, hash, size in members:
+                    yield hash, False
+                continue
+
+            with open(fn, 'rb') as f:
+                for offset, hash, size in sorted(members):
+                    f.seek(offset)
+                    data = f.read(size)
+                    h = HASH_ALGOS[self.catalog.algo]()
+                    h.update(data)
+                    if len(data) != size or h.hexdigest() != hash:
+                        data = False
+                    yield hash, data
+            os.unlink(fn)
+
+    def unpack_packs(self, hashes, files):
+        """Put into place the local files with hashes "hashes" (which must be in
+        the catalog), as given by "files" (dict of hash -> list of file names),
+        taking their contents from packs (see read_packs()). Their mtimes are not set
+        (see unpacked()). Return a dict of hash -> True if done, False if corrupted,
+        and None if not in remote repo."""
+
+        done = {}
+        for hash, data in self.read_packs(hashes):
+            if data is None or data is False:
+                done[hash] = data
+                continue
+
+            for name in files[hash]:
+                fullname = os.path.join(self.cfg.conf['LOCALDIR'], name)
+                os.makedirs(os.path.dirname(fullname), exist_ok=True)
+                with open(fullname + PART_SUFFIX, 'wb') as f:
+                    f.write(data)
+                os.replace(fullname + PART_SUFFIX, fullname)
+            done[hash] = True
+
+        return done
+
+    def gc_packs(self, hashes):
+        """Forget in the catalog all hashes but "hashes" (those in remote index), and
+        repack what is left in packs mostly dead (see packs.Catalog.garbage()).
+        Return list of packs no longer needed, to be removed from remote repo once
+        the catalog is saved."""
+
+        self.catalog.keep(hashes)
+        empty, repack = self.catalog.garbage(self.pack_size)
+
+        if repack:
+            print('\n')
+            w = self.pack_writer()
+            for hash, data in self.read_packs([ entry[0] for entry in self.catalog.members(repack) ]):
+                if data is None or data is False:
+                    print('\033[31m[NOOK]\033[0m {0} (in pack)'.format(hash))
+                else:
+                    w.add(hash, data)
+            w.close()
+
+        old = empty + repack
+        if old and self.options.verbosity < 2:
+            fmt = '\033[32m[GC]\033[0m {0} packs repacked, {1} with nothing alive removed'
+            print(fmt.format(len(repack), len(empty)))
+        self.catalog.drop(old)
+
+        return old
+
+    def split(self, todo):
+        """Upload the local files in "todo" (a list of (name, hash) tuples) as chunks,
+        see split_file(). Contents already chunked are skipped, and so are
+        duplicates."""
+
+        known = self.chunkmap.chunks() | self.journal.values('chunk')
+        for name, hash in todo:
+            if not hash in self.chunkmap:
+                self.split_file(name, hash, known)
+
+    def split_file(self, name, hash, known):
+        """Cut local file "name" (with hash "hash") in chunks (see cdc.split()), and
+        upload the ones not in "known" (a set of chunk hashes, to which they are
+        added), see send_chunks(). Chunks are staged in tmpdir in batches of
+        chunk_bytes() bytes at most, taking room in self.budget. The file is then
+        added to the map of chunks, and logged in the journal, to resume
+        interrupted runs (see read_chunkmap())."""
+
+        fullname = os.path.join(self.cfg.conf['LOCALDIR'], name)
+        compress = self.compressible(fullname)
+
+        members = [] # list of (chunk hash, size) tuples
+        batch = []   # chunks staged in tmpdir, not sent yet
+        nbytes = 0
+        new = 0
+        with open(fullname, 'rb') as f:
+            for data in cdc.split(f, self.chunk_size):
+                h = HASH_ALGOS[self.chunkmap.chunk_algo]()
+                h.update(data)
+                chunk = h.hexdigest()
+                members.append((chunk, len(data)))
+                if chunk in known:
+                    continue
+
+                # Send the ones staged so far, if no room left for this one
+                # (staged, and then GPG-ed):
+                if batch and (nbytes + len(data) > self.chunk_bytes() or not self.budget.fits(2*len(data))):
+                    self.send_chunks(batch, compress)
+                    batch = []
+                    nbytes = 0
+
+                self.budget.take(chunk, 2*len(data))
+                with open('{0}/chunks/{1}'.format(self.tmpdir, chunk), 'wb') as out:
+                    out.write(data)
+                batch.append(chunk)
+                nbytes += len(data)
+                known.add(chunk)
+                new += 1
+
+        self.send_chunks(batch, compress)
+
+        self.journal.log('chunked', '{0}|{1}'.format(hash, cdc.encode(members)))
+        self.chunkmap.add(hash, members)
+
+        if self.options.verbosity < 2:
+            fmt = '\033[32m[CHNK]\033[0m {0} ({1} of {2} chunks new)'
+            print(fmt.format(fitit(name), new, len(members)))
+
+    def send_chunks(self, batch, compress=True):
+        """GPG the chunks with hashes in "batch", staged in tmpdir (with up to
+        self.jobs() gpg processes at a time, see gpg_encrypt() for "compress"), and
+        upload them to remote repo, with a single rsync. They are logged in the
+        journal, and removed from tmpdir (giving back their room in self.budget)."""
+
+        if not batch:
+            return
+
+        def gpg(chunk):
+            fn = '{0}/chunks/{1}'.format(self.tmpdir, chunk)
+            self.gpg_encrypt(fn, fn + '.gpg', compress)
+            os.unlink(fn)
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+                list(pool.map(gpg, batch))
+
+            self.transfer(batch, dir='chunks')
+            for chunk in batch:
+                self.journal.log('chunk', chunk)
+        finally:
+            for chunk in batch:
+                for fn in '{0}/chunks/{1}'.format(self.tmpdir, chunk), '{0}/chunks/{1}.gpg'.format(self.tmpdir, chunk):
+                    if os.path.exists(fn):
+                        os.unlink(fn)
+                self.budget.give(chunk)
+
+    def gpg_files(self, todo, done=None):
+        """GPG the local files in "todo" (a list of (name, hash) tuples) into tmpdir,
+        with up to self.jobs() gpg processes at a time. Files are reported in order,
+        as they are done (and their hash given to function "done", if any). Files
+        already GPG-ed (or even uploaded) are skipped, and so are duplicates. Room
+        in self.budget is taken for each file before it is GPG-ed (it is up to
+        whoever gets it from "done" to give it back). If some gpg fails (or "done"
+        raises), the files not started yet are skipped, and the failure is raised
+        once the running ones are done."""
+
+        # Only GPG if not GPGed (or even uploaded) yet, and only once per hash:
+        seen = set()
+        jobs = []
+        for name, hash in todo:
+            if hash in seen or self.journal.has('gpg', hash) or self.journal.has('up', hash):
+                continue
+            seen.add(hash)
+            jobs.append((name, hash))
+
+        if not jobs:
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            fs = []         # futures of files submitted so far, in order
+            pending = set() # futures not done yet
+            i = 0           # files reported so far
+            try:
+                while i < len(jobs):
+                    # Submit next file, if there is room for it in tmpdir (waiting
+                    # for it only if nothing is left to be done or reported, that is,
+                    # if we wait for files already reported to be uploaded):
+                    if len(fs) < len(jobs):
+                        name, hash = jobs[len(fs)]
+                        src = os.path.join(self.cfg.conf['LOCALDIR'], name)
+                        wait = None if not pending and i == len(fs) else 0
+                        if self.budget.take(hash, os.path.getsize(src), timeout=wait):
+                            dst = '{0}/data/{1}.gpg'.format(self.tmpdir, hash)
+                            f = pool.submit(self.gpg_encrypt, src, dst, None)
+                            fs.append(f)
+                            pending.add(f)
+                            continue
+
+                    # Otherwise, wait for some file to be done, and report (in order)
+                    # files done so far:
+                    finished, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for f in finished:
+                        f.result()
+                    while i < len(fs) and fs[i].done():
+                        name, hash = jobs[i]
+                        if self.options.verbosity < 2:
+                            print('\033[32m[GPG]\033[0m {0}'.format(fitit(name)))
+                        self.journal.log('gpg', hash)
+                        i += 1
+                        if done:
+                            done(hash)
+            except BaseException:
+                for f in fs:
+                    f.cancel()
+
+                # Log the ones done anyway, not to GPG them again if resumed:
+                futures.wait(fs)
+                for (name, hash), f in zip(jobs[i:], fs[i:]):
+                    if not f.cancelled() and f.exception() is None:
+                        self.journal.log('gpg', hash)
+                raise
+
+    def pipe_files(self, todo):
+        """Like gpg_files(), but GPG-ing the local files in "todo" straight into
+        remote repo (see pipe_up()). Files already uploaded are skipped, and so
+        are duplicates. Uploaded files are logged in the journal, as they are done.
+        If some upload fails, the ones not started yet are skipped, and the failure
+        is raised once the running ones are done."""
+
+        seen = set()
+        jobs = []
+        for name, hash in todo:
+            if hash in seen or self.journal.has('up', hash):
+                continue
+            seen.add(hash)
+            jobs.append((name, hash))
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            fs = [ pool.submit(self.pipe_up, name, hash) for name, hash in jobs ]
+
+            # Report (in order) files done so far:
+            i = 0
+            try:
+                for (name, hash), f in zip(jobs, fs):
+                    f.result()
                     if self.options.verbosity < 2:
-                        string = '\033[32m[GPG]\033[0m {0}'.format(fitit(name))
-                        print(string)
-                    cmnd = '{0.gpgcom} -o {1} '.format(self, lfile)
-                    for recipient in self.cfg.prefs['RECIPIENTS']:
-                        cmnd += ' -r {0} '.format(recipient)
-                    cmnd += ' -e "{0}" '.format(v.fullname())
-                    #fmt = '{0} -r {1} -o "{2}" -e "{3}"'
-                    #cmnd = fmt.format(self.gpgcom, self.cfg.prefs['RECIPIENT'], lfile, v.fullname())
-                    self.doit(cmnd,2)
+                        print('\033[32m[UP]\033[0m {0}'.format(fitit(name)))
+                    self.journal.log('up', hash)
+                    i += 1
+            except BaseException:
+                for f in fs:
+                    f.cancel()
+
+                # Log the ones done anyway, not to upload them again if resumed:
+                futures.wait(fs)
+                for (name, hash), f in zip(jobs[i:], fs[i:]):
+                    if not f.cancelled() and f.exception() is None:
+                        self.journal.log('up', hash)
+                raise
+
+    def pipe_up(self, name, hash):
+        """GPG local file "name" straight into remote repo, as the GPG file of hash
+        "hash", piping gpg into a remote command (see remote_command()). The file is
+        written to a temporary file there, renamed into place (with a second remote
+        command) only if both gpg and the remote command succeeded, and removed
+        otherwise."""
+
+        src = os.path.join(self.cfg.conf['LOCALDIR'], name)
+        dir = self.remote_dir()
+        dst = os.path.join(dir, hash + '.gpg')
+        part = shlex.quote(dst + PART_SUFFIX)
+        rcmnd = 'mkdir -p {0} && cat > {1}'.format(shlex.quote(dir), part)
+
+        cmnd = self.encrypt_command(src, compress=None)
+        args = self.remote_command(rcmnd)
+        command = '{0} | {1}'.format(cmnd, ' '.join(map(shlex.quote, args)))
+        if not self.options.verbosity < 2:
+            print(command)
+
+        gpg = sp.Popen(cmnd, stdout=sp.PIPE, shell=True)
+        remote = sp.Popen(args, stdin=gpg.stdout)
+        gpg.stdout.close() # for gpg to get SIGPIPE if remote command dies
+        remote.wait()
+        gpg.wait()
+
+        if gpg.returncode != 0 or remote.returncode != 0:
+            sp.call(self.remote_command('rm -f {0}'.format(part)))
+            print('Error running command:\n{0}'.format(command))
+            sys.exit()
+
+        rcmnd = 'mv {0} {1}'.format(part, shlex.quote(dst))
+        self.doit(' '.join(map(shlex.quote, self.remote_command(rcmnd))), 2)
 
     def nuke_remote(self):
         """Remove the files not present (or newer) locally from remote repo."""
 
         if self.really_do:
-            fn_list = []
-            nuke_some = False
-
-            # Create a sftp script file to delete remote files:
-            tmpfile = os.path.join(self.tmpdir, 'nuke_remote.sftp')
-            with open(tmpfile,'w') as f:
-                f.write('sftp {0} <<EOF\n'.format(self.cfg.prefs['REMOTE']))
-
-                for fn in self.diff.remote + self.diff.newlocal:
-                    hash = self.files[fn].hash_remote
-                    line = 'rm {0[REPODIR]}/data/{1}.gpg\n'.format(self.cfg.conf, hash)
-                    f.write(line)
-                    nuke_some = True
-                    fn_list.append(fn)
-                f.write('exit\nEOF\n')
-            if nuke_some:
-                print('\n')
+            fn_list = self.diff.remote + self.diff.newlocal
+
+            # Remove the ones not removed in a previous interrupted run (packed
+            # and chunked ones are not removed, but dropped from catalog and map
+            # of chunks, see save()):
+            hashes = [ self.files[fn].hash_remote for fn in fn_list ]
+            hashes = [ h for h in hashes if not self.journal.has('rm', h) and not h in self.catalog and not h in self.chunkmap ]
+            self.remove_remote(hashes)
+            for h in hashes:
+                self.journal.log('rm', h)
+
+            # Delete nuked files from list of remote files:
+            for fn in fn_list:
+                self.files[fn].flags &= ~REMOTE
+
+    def remove_remote(self, hashes, dir='data'):
+        """Remove the GPG files of given hashes (in subdir "dir") from remote repo,
+        with a single sftp script. Return True if there was something to remove."""
+
+        nuke_some = False
+
+        # Create a sftp script file to delete remote files:
+        tmpfile = os.path.join(self.tmpdir, 'nuke_remote.sftp')
+        with open(tmpfile,'w') as f:
+            f.write('sftp {0} <<EOF\n'.format(self.cfg.prefs['REMOTE']))
+
+            for hash in hashes:
+                line = 'rm {0[REPODIR]}/{1}/{2}.gpg\n'.format(self.cfg.conf, dir, hash)
+                f.write(line)
+                nuke_some = True
+            f.write('exit\nEOF\n')
+
+        if nuke_some:
+            print('\n')
 
-                # Execute sftp script:
-                cmnd = 'bash {0}'.format(tmpfile)
-                self.doit(cmnd)
+            # Execute sftp script:
+            cmnd = 'bash {0}'.format(tmpfile)
+            self.doit(cmnd)
+
+        return nuke_some
+
+    def migrate_hash(self):
+        """Re-key the remote repo from the hash algorithm of its index to the one
+        configured for the repo. The hashes are calculated from the local copy of
+        each file, if it is unchanged, or from the decrypted remote blob (or pack, or
+        chunks) otherwise. The blobs are then renamed in place, not uploaded again,
+        and the packed and chunked hashes re-keyed in the catalog and map of chunks
+        (chunks keep their names)."""
+
+        old, new = self.remote_algo, self.algo
+        total = len(set([ self.files[name].hash_remote for name in self.files.names(REMOTE) ]))
+
+        rekey = {} # dict of old hash -> new hash
+        lista = [] # old hashes of files we must download to hash
+        for name in self.files.names(REMOTE):
+            v = self.files[name]
+            if v.hash_remote in rekey:
+                continue
+
+            # Try the local copy first:
+            fn = v.fullname()
+            try:
+                st = os.stat(fn)
+                if st.st_size == v.size_remote:
+                    old_hash, new_hash = hashesof(fn, [old, new])
+                    if old_hash == v.hash_remote:
+                        rekey[old_hash] = new_hash
+                        self.hash_cache.set(st, name, new_hash)
+                        continue
+            except OSError:
+                pass
+
+            lista.append(v.hash_remote)
+
+        # Remote blobs with no local copy must be downloaded (not uploaded):
+        lista = sorted(set(lista) - set(rekey))
+
+        packed = [ h for h in lista if h in self.catalog ]
+        for h, data in self.read_packs(packed):
+            if data is None:
+                print('\033[31m[MISS]\033[0m {0} (in pack)'.format(h))
+            elif data is False:
+                msg = '\033[31m[NOOK]\033[0m {0} (in pack) is corrupt. Nothing was re-keyed.'
+                sys.exit(msg.format(h))
+            else:
+                hasher = HASH_ALGOS[new]()
+                hasher.update(data)
+                rekey[h] = hasher.hexdigest()
+
+        chunked = [ h for h in lista if h in self.chunkmap and not h in self.catalog ]
+        for h in chunked:
+            with open(os.devnull, 'wb') as out:
+                act = self.join(h, out, algos=[old, new])
+            if act is None:
+                print('\033[31m[MISS]\033[0m {0} (in chunks)'.format(h))
+            elif not act or act[0] != h:
+                msg = '\033[31m[NOOK]\033[0m {0} (in chunks) is corrupt. Nothing was re-keyed.'
+                sys.exit(msg.format(h))
+            else:
+                rekey[h] = act[1]
+
+        lista = [ h for h in lista if not h in self.catalog and not h in self.chunkmap ]
+        if lista:
+            self.transfer(lista, up=False)
+
+            for h in lista:
+                fn = '{0}/data/{1}.gpg'.format(self.tmpdir, h)
+                if not os.path.exists(fn):
+                    print('\033[31m[MISS]\033[0m {0}.gpg'.format(h))
+                    continue
+
+                cmnd = '{0} -d "{1}"'.format(self.gpgcom, fn)
+                s = sp.Popen(cmnd, stdout=sp.PIPE, shell=True)
+                old_hash, new_hash = hash_stream(s.stdout, [old, new])
+                s.wait()
+                os.unlink(fn)
+
+                if s.returncode != 0 or old_hash != h:
+                    msg = '\033[31m[NOOK]\033[0m {0}.gpg is corrupt. Nothing was re-keyed.'
+                    sys.exit(msg.format(h))
+
+                rekey[h] = new_hash
+
+        # Rename blobs in remote repo:
+        tmpfile = os.path.join(self.tmpdir, 'rekey_remote.sftp')
+        with open(tmpfile,'w') as f:
+            f.write('sftp {0} <<EOF\n'.format(self.cfg.prefs['REMOTE']))
+            for old_hash, new_hash in sorted(rekey.items()):
+                if self.options.verbosity > 0:
+                    print('[KEY] {0} -> {1}'.format(old_hash, new_hash))
+                if old_hash in self.catalog or old_hash in self.chunkmap:
+                    continue
+                line = 'rename {0[REPODIR]}/data/{1}.gpg {0[REPODIR]}/data/{2}.gpg\n'
+                f.write(line.format(self.cfg.conf, old_hash, new_hash))
+            f.write('exit\nEOF\n')
+        self.doit('bash {0}'.format(tmpfile))
+        if len(self.catalog):
+            self.catalog.rekey(rekey, new)
+        if len(self.chunkmap):
+            self.chunkmap.rekey(rekey, new)
+
+        # Update index (missing blobs are dropped from it):
+        for name in self.files.names(REMOTE):
+            v = self.files[name]
+            if v.hash_remote in rekey:
+                v.hash_remote = rekey[v.hash_remote]
+            else:
+                v.flags &= ~REMOTE
+        self.remote_algo = new
+        self.hash_cache.save()
 
-                # Delete nuked files from list of remote files:
-                for fn in fn_list:
-                    del self.files_remote[fn]
+        fmt = '{0} of {1} blobs re-keyed from {2} to {3}'
+        print(fmt.format(len(rekey), total, old, new))
 
     def enumerate(self,summary=True):
         if self.options.up:
@@ -859,100 +2415,417 @@ class Repositories(object):
 
     def download(self):
         """Execute the downloading of remote files not in local, or
-        superceding the ones in local."""
+        superceding the ones in local. Files are downloaded in chunks (up to CHUNK
+        files and chunk_bytes() bytes), by a thread of its own (see FetchQueue), and
+        the files of each chunk are put into place (see place()) while the next
+        chunk is being downloaded."""
 
-        # List of file(-hashe)s to download:
-        lista = []
-        for h in self.diff.remote_hash:
-            lista.append(h)
-        for h in self.diff.newremote_hash:
-            lista.append(h)
+        # Files to download (or try to), by hash:
+        files = {} # dict of hash -> list of file names
+        for fn in self.diff.remote + self.diff.newremote:
+            files.setdefault(self.files[fn].hash_remote, []).append(fn)
 
-        # Check which ones present remotely:
-        dir = self.cfg.conf['REPODIR']
-        server = self.cfg.prefs['REMOTE']
-        newlist = get_present_files(server, dir, lista)
-
-        # Proceed only if some or all are present:
-        if newlist:
-            # Build list of files to dl from repo (defined by md5 hash):
-            tmpfile = '{0}/filelist.txt'.format(self.tmpdir)
-            with open(tmpfile,'w') as f:
-                for h in newlist:
-                    f.write(h+'.gpg\n')
-            # Download all of them from repo to tmpdir:
-            fmt = '{0.rsync} -vh --progress {0.cfg.prefs[REMOTE]}/{0.cfg.conf[REPODIR]}/data/ --files-from={1}'
-            fmt += ' {0.tmpdir}/data/'
-            cmnd = fmt.format(self,tmpfile)
-            try:
-                self.doit(cmnd,2)
-                os.unlink(tmpfile)
-            except:
-                return False
+        if files:
+            print('\n')
 
-        # List of file names of files we just downloaded (or tried to):
-        file_list = []
+        # Take the ones in packs from them, and then the chunked ones:
+        packed = [ h for h in files if h in self.catalog ]
+        if packed:
+            self.place(packed, files, self.unpack_packs(packed, files))
 
-        for fn in self.diff.remote:
-            file_list.append(fn)
+        chunked = [ h for h in files if h in self.chunkmap ]
+        if chunked:
+            self.place(chunked, files, self.join_chunks(chunked, files))
 
-        for fn in self.diff.newremote:
-            file_list.append(fn)
+        # Check which ones present remotely:
+        dir = self.cfg.conf['REPODIR']
+        server = self.cfg.prefs['REMOTE']
+        present = get_present_files(server, dir, list(files))
 
-        # Un-GPG from tmpdir dir to final destination in local:
-        if file_list:
-            print('\n')
+        def sizeof(h):
+            return self.staged_size(self.files[files[h][0]].size_remote)
 
-        for fn in file_list:
-            file = self.files[fn]
-            fgpg = '{0}.gpg'.format(file.hash_remote)
+        # With --pipe (or if too big for tmpdir), un-GPG them straight from remote
+        # repo into place:
+        piped = [ h for h in present if self.options.pipe or self.too_big(sizeof(h)) ]
+        if piped:
+            self.place(piped, files, self.pipe_down(piped, files))
+            present = [ h for h in present if h in files ]
 
-            # Source GPG file:
-            fn = '{0}/data/{1}'.format(self.tmpdir, fgpg)
+        if present:
+            batches = ( (chunk, None) for chunk in chunks(present, self.CHUNK, self.chunk_bytes(), sizeof) )
 
-            if os.path.exists(fn):
-                # Create local dir to accomodate file, if necessary:
-                dir_to = file.fullname().split('/')[:-1]
-                dir_to = '/'.join(dir_to)
-                if not os.path.isdir(dir_to):
-                    os.makedirs(dir_to)
-                # First un-GPG it to tmp dir:
-                cmnd = '{0} -o "{1}/tmp" -d "{2}"'.format(self.gpgcom, self.tmpdir, fn)
-                self.doit(cmnd,2)
-
-                # Then check if not corrupted:
-                ref = file.hash_remote
-                act = hashof('{0}/tmp'.format(self.tmpdir))
-                
-                if ref == act: # then it is OK. Proceed:
-                    # Warn of what is being done:
-                    print('\033[32m[DOWN]\033[0m {0}'.format(fitit(file.name)))
+            # Put files into place as they are downloaded:
+            fetches = FetchQueue(self, batches, sizeof)
+            try:
+                for hashes, data in fetches:
+                    self.place(hashes, files)
+            finally:
+                ok = fetches.close()
+
+            if not ok:
+                return False
+
+        # Then the ones not present remotely:
+        self.place(list(files), files)
+
+        # If all went OK, return True:
+        return True
 
-                    # Move tmp file into actual destination:
-                    cmnd = 'mv -f "{0}/tmp" "{1}"'.format(self.tmpdir,file.fullname())
-                    self.doit(cmnd)
+    def place(self, hashes, files, done=None):
+        """Un-GPG the downloaded GPG files of hashes "hashes", and put them into place
+        as the local files with them in "files" (dict of hash -> list of file names,
+        from which they are removed), logging changes. The GPG files are removed from
+        tmpdir afterwards. If "done" is given (dict of hash -> True, False or None,
+        see unpacked()), the files were put into place already (e.g. by pipe_down(),
+        unpack_packs() or join_chunks()), and are only logged."""
+
+        if done is None:
+            self.decrypt(hashes)
+
+        for h in hashes:
+            names = files.pop(h)
+            for i, fn in enumerate(names):
+                file = self.files[fn]
+                if done is not None:
+                    placed = self.unpacked(file.name, file.mtime_remote, done[h])
+                else:
+                    placed = self.unpack(file.name, h, file.mtime_remote, last=i == len(names)-1)
 
+                if placed:
                     # Log changes:
+                    file.flags      |= LOCAL
                     file.hash_local  = file.hash_remote
                     file.size_local  = file.size_remote
                     file.mtime_local = file.mtime_remote
+                    self.diff.placed.append(fn)
 
-                    # Touch file accordingly:
-                    os.utime(file.fullname(),(-1,file.mtime_remote))
-                    
-                else:
-                    msg  = '\033[31m[NOOK]\033[0m {0}\n'.format(file.name)
-                    msg += '\033[33m[IGNO]\033[0m {0}'.format(file.name)
-                    print(msg)
+                    # We know its hash already (we just checked it):
+                    st = os.stat(file.fullname())
+                    self.stat_local(file, st)
+                    self.hash_cache.set(st, file.name, file.hash_remote)
 
-            else:
-                # Then file was not physically in repo:
-                print('\033[31m[MISS]\033[0m %s' % (file.name))
-                del self.files_remote[file.name]
+                elif placed is None:
+                    # Then file was not physically in repo:
+                    file.flags &= ~REMOTE
+
+            self.remove_blob(h)
+
+    def remove_blob(self, hash):
+        """Remove downloaded GPG file of hash "hash" from tmpdir (and its un-GPG-ed
+        version, if left), giving back its room in self.budget."""
+
+        for fn in '{0}/data/{1}.gpg'.format(self.tmpdir, hash), '{0}/data/{1}'.format(self.tmpdir, hash):
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+        self.budget.give(hash)
+
+    def decrypt(self, hashes):
+        """Un-GPG the downloaded GPG files of hashes "hashes" (those present and
+        smaller than STREAM_SIZE) into tmpdir, each into a file named after its hash.
+        Files are decrypted in batches (a single gpg process decrypting many files),
+        run in parallel (up to self.jobs() at a time), to save on gpg start up time.
+        Files that can not be decrypted are left out (see unpack())."""
+
+        blobs = []
+        for h in sorted(set(hashes)):
+            fn = '{0}/data/{1}.gpg'.format(self.tmpdir, h)
+            if os.path.exists(fn) and os.path.getsize(fn) < self.STREAM_SIZE:
+                blobs.append(fn)
+
+        if not blobs:
+            return
+
+        # As many batches as workers, up to CHUNK files each:
+        size = min(self.CHUNK, -(-len(blobs) // self.jobs()))
+        batches = list(chunks(blobs, size))
+
+        def decrypt_batch(i, batch):
+            # Give file names through stdin, to avoid too long command lines:
+            tmpfile = '{0}/decrypt.{1}.txt'.format(self.tmpdir, i)
+            with open(tmpfile, 'w') as f:
+                for fn in batch:
+                    f.write(fn + '\n')
+
+            # Errors are not fatal here (gpg goes on with the rest of files):
+            cmnd = '{0} --batch --decrypt-files < "{1}"'.format(self.gpgcom, tmpfile)
+            self.doit(cmnd, 2, fatal_errors=False)
+            os.unlink(tmpfile)
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            for f in [ pool.submit(decrypt_batch, i, batch) for i, batch in enumerate(batches) ]:
+                f.result()
+
+    def unpack(self, name, hash, mtime, last=True):
+        """Put the GPG file of hash "hash", downloaded into tmpdir, into local file
+        "name", checking it is not corrupted, and set its mtime to "mtime". Small
+        files were un-GPG-ed into tmpdir already (see decrypt()), and are checked
+        and moved into place. If not "last", other files have the same contents, so
+        the un-GPG-ed file is copied, not moved. Big files are un-GPG-ed here, see
+        unpack_stream(). Return True if done, False if the file was corrupted, and
+        None if it was not downloaded (because it was not physically in repo)."""
+
+        # Source GPG file, and un-GPG-ed one:
+        fn = '{0}/data/{1}.gpg'.format(self.tmpdir, hash)
+        plain = '{0}/data/{1}'.format(self.tmpdir, hash)
+        fullname = os.path.join(self.cfg.conf['LOCALDIR'], name)
+
+        if not os.path.exists(fn):
+            print('\033[31m[MISS]\033[0m %s' % (name))
+            return None
+
+        # Create local dir to accomodate file, if necessary:
+        dir_to = os.path.dirname(fullname)
+        if not os.path.isdir(dir_to):
+            os.makedirs(dir_to)
+
+        if os.path.getsize(fn) >= self.STREAM_SIZE:
+            ok = self.unpack_stream(fn, hash, fullname)
+        else:
+            # Check if not corrupted (or not un-GPG-ed at all):
+            ok = os.path.exists(plain) and hashof(plain, self.algo) == hash
+            if ok:
+                # Move un-GPG-ed file into actual destination:
+                if not last:
+                    tmp = '{0}/tmp'.format(self.tmpdir)
+                    shutil.copyfile(plain, tmp)
+                    plain = tmp
+                shutil.move(plain, fullname)
+
+        return self.unpacked(name, mtime, ok)
+
+    def unpacked(self, name, mtime, ok):
+        """Report local file "name" as put into place if "ok" (and set its mtime to
+        "mtime"), as not in remote repo if None, or as corrupted otherwise. Return
+        "ok"."""
+
+        if ok is None:
+            print('\033[31m[MISS]\033[0m %s' % (name))
+            return None
+
+        if not ok:
+            msg  = '\033[31m[NOOK]\033[0m {0}\n'.format(name)
+            msg += '\033[33m[IGNO]\033[0m {0}'.format(name)
+            print(msg)
+            return False
+
+        # Then it is OK, warn of what was done:
+        print('\033[32m[DOWN]\033[0m {0}'.format(fitit(name)))
+
+        # Touch file accordingly:
+        os.utime(os.path.join(self.cfg.conf['LOCALDIR'], name), (-1,mtime))
+
+        return True
+
+    def unpack_stream(self, fn, hash, fullname):
+        """Un-GPG file "fn" into local file "fullname", hashing its output as it is
+        written to a temporary file next to "fullname" (so that checking it does not
+        take reading it again). The temporary file is renamed into place only if
+        its hash is "hash". Return True if so. If "fn" is None, the GPG file of hash
+        "hash" is read straight from remote repo instead (see remote_command())."""
+
+        tmp = fullname + PART_SUFFIX
+        src = None
+        if fn is None:
+            rcmnd = 'cat {0}'.format(shlex.quote(os.path.join(self.remote_dir(), hash + '.gpg')))
+            src = sp.Popen(self.remote_command(rcmnd), stdout=sp.PIPE)
+            cmnd = '{0} -d'.format(self.gpgcom)
+        else:
+            cmnd = '{0} -d "{1}"'.format(self.gpgcom, fn)
+        if not self.options.verbosity < 2:
+            print(cmnd)
+
+        s = sp.Popen(cmnd, stdin=src and src.stdout, stdout=sp.PIPE, shell=True)
+        if src:
+            src.stdout.close() # for remote command to get SIGPIPE if gpg dies
+        with open(tmp, 'wb') as f:
+            act = hash_stream(s.stdout, [self.algo], out=f)[0]
+        s.wait()
+        if src:
+            src.wait()
+
+        if s.returncode != 0 or act != hash or (src and src.returncode != 0):
+            os.unlink(tmp)
+            return False
+
+        os.replace(tmp, fullname)
 
-        # If all went OK, return True:
         return True
 
+    def pipe_down(self, hashes, files):
+        """Un-GPG the GPG files of hashes "hashes" straight from remote repo into
+        place, without downloading them (see unpack_stream()), as the local files
+        with them in "files" (dict of hash -> list of file names), up to self.jobs()
+        at a time. Their mtimes are not set (see unpacked()). Return a dict of hash
+        -> True if done, False if corrupted."""
+
+        def fetch(hash):
+            fullnames = [ os.path.join(self.cfg.conf['LOCALDIR'], name) for name in files[hash] ]
+            for fullname in fullnames:
+                os.makedirs(os.path.dirname(fullname), exist_ok=True)
+
+            if not self.unpack_stream(None, hash, fullnames[0]):
+                return False
+
+            # Other files with the same contents are copied:
+            for fullname in fullnames[1:]:
+                shutil.copyfile(fullnames[0], fullname + PART_SUFFIX)
+                os.replace(fullname + PART_SUFFIX, fullname)
+
+            return True
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            return dict(zip(hashes, pool.map(fetch, hashes)))
+
+    def join_chunks(self, hashes, files):
+        """Put into place the local files with hashes "hashes" (which must be in the
+        map of chunks), as given by "files" (dict of hash -> list of file names),
+        joining their chunks (see join()). Chunks in the local files being replaced,
+        or in the ones put into place before them, are taken from them, and only the
+        rest downloaded. Their mtimes are not set (see unpacked()). Return a dict of
+        hash -> True if done, False if corrupted, and None if some chunk is not in
+        remote repo."""
+
+        done = {}
+        placed = {} # dict of chunk hash -> (path, offset) of chunks in files put into place
+        for hash in hashes:
+            fullnames = [ os.path.join(self.cfg.conf['LOCALDIR'], name) for name in files[hash] ]
+            for fullname in fullnames:
+                os.makedirs(os.path.dirname(fullname), exist_ok=True)
+
+            have = {}
+            for fn in fullnames:
+                if os.path.isfile(fn) and not os.path.islink(fn):
+                    have = self.local_chunks(fn)
+                    break
+
+            tmp = fullnames[0] + PART_SUFFIX
+            with open(tmp, 'wb') as out:
+                act = self.join(hash, out, collections.ChainMap(have, placed))
+
+            if not act or act[0] != hash:
+                os.unlink(tmp)
+                done[hash] = None if act is None else False
+                continue
+            os.replace(tmp, fullnames[0])
+
+            # Other files with the same contents are copied:
+            for fullname in fullnames[1:]:
+                shutil.copyfile(fullnames[0], fullname + PART_SUFFIX)
+                os.replace(fullname + PART_SUFFIX, fullname)
+            done[hash] = True
+
+            offset = 0
+            for chunk, size in self.chunkmap.get(hash):
+                placed.setdefault(chunk, (fullnames[0], offset))
+                offset += size
+
+        return done
+
+    def local_chunks(self, fn):
+        """Return dict of chunk hash -> (path, offset) of the chunks local file "fn"
+        is cut in (see cdc.split())."""
+
+        have = {}
+        offset = 0
+        with open(fn, 'rb') as f:
+            for data in cdc.split(f, self.chunk_size):
+                h = HASH_ALGOS[self.chunkmap.chunk_algo]()
+                h.update(data)
+                have.setdefault(h.hexdigest(), (fn, offset))
+                offset += len(data)
+
+        return have
+
+    def join(self, hash, out, have=None, algos=None):
+        """Write the contents with hash "hash" (which must be in the map of chunks)
+        to file object "out", joining its chunks. Chunks in local files, as given
+        by "have" (mapping of chunk hash -> (path, offset)), are read from them, and
+        the rest downloaded, in batches of up to chunk_bytes() bytes (see
+        fetch_chunks()), in the order they are needed. Return list of the hashes of
+        what was written, calculated with algorithms "algos" (by default, that of
+        the repo), or None if some chunk is not in remote repo, and False if some
+        is corrupted."""
+
+        members = self.chunkmap.get(hash)
+        have = have or {}
+        algos = algos or [self.algo]
+
+        # Chunks to download, in the order they are needed (each removed from
+        # tmpdir once used for the last time):
+        sizes = dict(members)
+        last = dict( (chunk, i) for i, (chunk, size) in enumerate(members) )
+        todo = [ chunk for chunk in sizes if not chunk in have ] # dicts keep insertion order
+        batches = chunks(todo, self.CHUNK, self.chunk_bytes(), lambda chunk: 2*sizes[chunk])
+
+        if self.options.verbosity > 0:
+            print('[CHNK] {0}: {1} of {2} chunks to download'.format(hash, len(todo), len(members)))
+
+        hs = [ HASH_ALGOS[algo]() for algo in algos ]
+        srcs = {}     # dict of path -> open local file
+        fetched = set()
+        try:
+            for i, (chunk, size) in enumerate(members):
+                if chunk in have:
+                    fn, offset = have[chunk]
+                    if not fn in srcs:
+                        srcs[fn] = open(fn, 'rb')
+                    srcs[fn].seek(offset)
+                    data = srcs[fn].read(size)
+                else:
+                    if not chunk in fetched:
+                        batch = next(batches)
+                        fetched.update(batch)
+                        ok = self.fetch_chunks(batch)
+                        if not ok:
+                            return ok
+
+                    fn = '{0}/chunks/{1}'.format(self.tmpdir, chunk)
+                    with open(fn, 'rb') as f:
+                        data = f.read()
+                    if last[chunk] == i:
+                        os.unlink(fn)
+
+                out.write(data)
+                for h in hs:
+                    h.update(data)
+        finally:
+            for f in srcs.values():
+                f.close()
+            for chunk in fetched:
+                fn = '{0}/chunks/{1}'.format(self.tmpdir, chunk)
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+        return [ h.hexdigest() for h in hs ]
+
+    def fetch_chunks(self, batch):
+        """Download the GPG files of the chunks with hashes in "batch" into tmpdir
+        (with a single rsync), and un-GPG them (up to self.jobs() at a time), checking
+        they are not corrupted. Return True if all went OK, None if some chunk is not
+        in remote repo, and False if some is corrupted."""
+
+        self.transfer(batch, up=False, dir='chunks', fatal_errors=False)
+
+        def decrypt(chunk):
+            fn = '{0}/chunks/{1}'.format(self.tmpdir, chunk)
+            if not os.path.exists(fn + '.gpg'):
+                return None
+
+            self.doit('{0} -o "{1}" -d "{1}.gpg"'.format(self.gpgcom, fn), 2, fatal_errors=False)
+            os.unlink(fn + '.gpg')
+
+            return os.path.exists(fn) and hashof(fn, self.chunkmap.chunk_algo) == chunk
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+            oks = list(pool.map(decrypt, batch))
+
+        if None in oks:
+            return None
+
+        return all(oks)
+
     def nuke_local(self):
         """When downloading, delete the local files not in remote repo."""
         
@@ -961,7 +2834,7 @@ class Repositories(object):
             self.doit(cmnd,2)
 
             if self.really_do:
-                del self.files_local[name]
+                self.files[name].flags &= ~LOCAL
 
     def say_nuke_local(self):
         if self.diff.local:
@@ -980,19 +2853,13 @@ class Repositories(object):
 
         if not self.really_do:
             if self.options.up:
-                for name in self.diff.local:
-                    size_up += self.files[name].size_local
-                for name in self.diff.newlocal:
-                    size_up += self.files[name].size_local
-                for name in self.diff.remote:
-                    size_rm += self.files[name].size_remote
+                size_up += self.size_of(self.diff.local, 'local')
+                size_up += self.size_of(self.diff.newlocal, 'local')
+                size_rm += self.size_of(self.diff.remote, 'remote')
             else:
-                for name in self.diff.remote:
-                    size_dn += self.files[name].size_remote
-                for name in self.diff.newremote:
-                    size_dn += self.files[name].size_remote
-                for name in self.diff.local:
-                    size_rm += self.files[name].size_local
+                size_dn += self.size_of(self.diff.remote, 'remote')
+                size_dn += self.size_of(self.diff.newremote, 'remote')
+                size_rm += self.size_of(self.diff.local, 'local')
         if self.really_do:
             up_msj = 'uploaded'
             dn_msj = 'downloaded'
@@ -1006,6 +2873,8 @@ class Repositories(object):
         else:
             print('\n{0:30}: {1}'.format('Number of files considered',self.walked))
             print('{0:30}: {1}'.format('Number of hashes calculated',self.hashed))
+            if self.hashed:
+                print('{0:30}: {1}/s'.format('Hashing speed',self.hash_rate()))
   
             if self.options.up:
                 msj = '{0} {1}'.format("Number of files",up_msj)
@@ -1025,21 +2894,96 @@ class Repositories(object):
     
                 print('{0:30}: {1}'.format("Diff files, newer locally",lddl))
 
+    def size_of(self, lista, which):
+        """Return total size of files in diff list "lista", as given by their
+        local or remote data (as "which" says)."""
+
+        if isinstance(lista, stream.Spool):
+            return lista.size
+
+        return sum([ getattr(self.files[name], 'size_' + which) for name in lista ])
+
     def clean(self):
         """Clean up, which basically means rm tmpdir."""
 
+        # All done, nothing to resume:
+        self.journal.clear()
+
         if not self.options.keep:
             if os.path.isdir(self.tmpdir):
                 shutil.rmtree(self.tmpdir)
 
     def get_index(self):
-        """Gets the remote index.dat file."""
-        
+        """Gets the remote index: the manifest of its shards (see send_shards()) and
+        the shards not in local cache, if sharded, or the index.dat file otherwise.
+        The layout configured for this repo is tried first.
+        A local copy of the remote index (kept in self.index_cache) is used instead,
+        without downloading or decrypting anything else, if the generation id of
+        the remote index (in index.gen, changed each time the index is uploaded)
+        is the same as that of the copy, and so is the size and mtime of the
+        remote index file(s) (see index_stamp())."""
+
+        # Reuse local copy of remote index, if unchanged since we last saw it:
+        self.generation = None
+        self.stamp = None
+        if self.fetch('index.gen'):
+            with open(os.path.join(self.tmpdir, 'index.gen')) as f:
+                self.generation = f.read().strip()
+            self.stamp = self.index_stamp()
+
+        self.index_reused = self.generation is not None and self.stamp is not None and \
+                            (self.generation, self.stamp) == self.cached_generation()
+        if self.index_reused:
+            if self.options.verbosity > 0:
+                print('[INFO] Remote index unchanged since last run, using local copy')
+
+            self.manifest = None
+            mfn = os.path.join(self.index_cache, 'manifest')
+            if os.path.isfile(mfn):
+                with open(mfn) as f:
+                    self.manifest = json.load(f)
+            return
+
+        layouts = [ 'index.dat.gpg', 'index/manifest.gpg' ]
+        if self.index_shards:
+            layouts.reverse()
+
+        for fn in layouts:
+            if self.fetch(fn):
+                break
+        else:
+            sys.exit('[ERROR] Could not download remote index')
+
+        # Catalog of packs and map of chunks (if any):
+        self.fetch('packs.dat.gpg')
+        self.fetch('chunks.dat.gpg')
+
+        self.manifest = None
+        if fn == 'index/manifest.gpg':
+            mfn = os.path.join(self.tmpdir, 'index', 'manifest')
+            self.doit('{0} -o "{1}" -d "{1}.gpg"'.format(self.gpgcom, mfn))
+            with open(mfn) as f:
+                self.manifest = json.load(f)
+
+            # Download shards not in cache:
+            lista = [ blob for blob in shard_blobs(self.manifest)
+                      if not os.path.isfile(os.path.join(self.index_cache, blob)) ]
+            if lista:
+                self.transfer(lista, up=False, dir='index')
+
+    def fetch(self, fn):
+        """Download file "fn" (path relative to remote repo) to same path in tmpdir.
+        Return True if succeeded."""
+
+        dir = os.path.join(self.tmpdir, os.path.dirname(fn))
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
         # Build command:
         cmnd1 = '{0.rsync}'.format(self)
-        cmnd2 = '  {0.prefs[REMOTE]}/{0.conf[REPODIR]}/index.dat.gpg'.format(self.cfg)
-        cmnd3 = '  {0.tmpdir}/'.format(self)
-        
+        cmnd2 = '  {0.prefs[REMOTE]}/{0.conf[REPODIR]}/{1}'.format(self.cfg, fn)
+        cmnd3 = '  {0}/'.format(dir)
+
         cmnd = cmnd1 + cmnd2 + cmnd3
 
         # Print command if requested:
@@ -1047,7 +2991,12 @@ class Repositories(object):
             print('\n' + cmnd1 + '\n' + cmnd2 + '\n' + cmnd3 + '\n')
 
         # Perform rsync:
-        self.doit(cmnd)
+        lfn = os.path.join(self.tmpdir, fn)
+        if os.path.isfile(lfn):
+            os.unlink(lfn)
+        self.doit(cmnd + ' 2>/dev/null', fatal_errors=False)
+
+        return os.path.isfile(lfn)
 
     def doit(self,command,level=1,fatal_errors=True):
         """Run/print command, depending on dry-run-nes and verbosity."""
@@ -1085,68 +3034,526 @@ class Repositories(object):
             # There was no difference:
             return False
 
-    def step_check(self, what=None):
-        """Check if some step has been completed in a previous run, and do not repeat."""
+    # --- Streaming mode (see --stream) --- #
 
-        # Directly avoid doing anything if command-line option --fresh was used:
-        if self.options.fresh:
-            return False
+    def stream_index(self, fn, strict=False):
+        """Return iterator over the entries of index file "fn", sorted by name,
+        or an empty one if there is no such file. If it holds hashes calculated
+        with some other algorithm, ignore it, or exit if "strict" is True (unless
+        it is empty). Index files not known to be sorted (e.g. written by older
+        versions) are sorted on disk first."""
+
+        if not os.path.isfile(fn):
+            return iter(())
+
+        algo, entries = index.read_index(fn)
+        if algo == self.algo:
+            if index.is_sorted(fn):
+                return entries
+
+            if self.options.verbosity > 0:
+                print('[INFO] Sorting "{0}", which is not sorted by name'.format(fn))
+
+            sorter = stream.Sorter(os.path.join(self.tmpdir, 'sort.' + os.path.basename(fn)))
+            for entry in entries:
+                sorter.add(entry)
+
+            return iter(sorter)
+
+        if strict:
+            for entry in entries:
+                fmt = 'Remote index uses {0} hashes, but repo is configured to use {1}. Run with --migrate-hash first.'
+                sys.exit(fmt.format(algo, self.algo))
+
+        elif self.options.verbosity > 0:
+            fmt = '[INFO] Ignoring "{0}", which holds {1} hashes (not {2})'
+            print(fmt.format(fn, algo, self.algo))
+
+        return iter(())
+
+    def stream_walk(self):
+        """Walk local dir, and return a stream.Sorter with a (name, size, mtime,
+        mtime_ns, inode) tuple for each file."""
+
+        walked = stream.Sorter(os.path.join(self.tmpdir, 'walk'))
+
+        for fname, entry in scantree(self.cfg.conf['LOCALDIR'], self.excluder):
+            self.walked += 1
+
+            if not entry.is_symlink() and not self.excluder.match(fname):
+                st = entry.stat(follow_symlinks=False)
+                walked.add((fname, st.st_size, int(st.st_mtime), st.st_mtime_ns, state.inode_of(st)))
+
+        return walked
+
+    def stream_remote(self, files, strict=False):
+        """Return iterator over the entries of the remote index (sorted by name),
+        given the list of (plaintext) files it is made of. See stream_index()."""
 
-        # Return and do nothing if not asked what step to check for:
-        if not what:
+        return heapq.merge(*[ self.stream_index(fn, strict) for fn in files ])
+
+    def stream_compare(self, remote_files):
+        """Streaming version of read(), walk(), save() and compare(): merge join the
+        local state, the local dir walk and the remote index files "remote_files",
+        all sorted by name. Hashes are calculated (in chunks, in parallel) only for
+        new files, or files whose size or mtime (in ns) changed, and not found in the
+        local state under some other name (see state.LocalState.digest_of()).
+        Changes to the local state are spooled as we go, and saved at the end. The
+        differences are saved to disk, in self.diff (a stream.StreamDiff)."""
+
+        old = self.read_state()
+        remote = self.stream_remote(remote_files, strict=True)
+        walked = self.stream_walk()
+
+        self.diff = stream.StreamDiff(self.tmpdir)
+        out = stream.Spool(os.path.join(self.tmpdir, 'state.changed'))
+        gone = stream.Spool(os.path.join(self.tmpdir, 'state.gone'))
+        t0 = time.time()
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=self.jobs()) as pool:
+                chunk = []
+                for row in stream.merge_join(old, walked, remote):
+                    chunk.append(row)
+                    if len(chunk) >= self.CHUNK:
+                        self.stream_chunk(chunk, pool, out, gone)
+                        chunk = []
+                self.stream_chunk(chunk, pool, out, gone)
+
+        except ValueError as e:
+            sys.exit('[ERROR] {0}'.format(e))
+
+        self.state.update(out.entries(), gone)
+        walked.close()
+        self.hashed_time += time.time() - t0
+
+        if self.hashed and (self.options.verbosity > 0 or self.options.timing):
+            fmt = '[MD5] {0} files, {1} ({2}/s)'
+            print(fmt.format(self.hashed, bytes2size(self.hashed_bytes), self.hash_rate()))
+
+    def stream_chunk(self, chunk, pool, out, gone):
+        """Process a chunk of (name, read, local, remote) rows of stream_compare():
+        hash the local files that need it with thread pool "pool", spool local
+        entries that changed to "out" (and names of files no longer there to
+        "gone"), and classify each file into self.diff."""
+
+        # Hash new/changed files in parallel (but for the ones renamed, moved, or
+        # hardlinked, whose hash is in local state already):
+        pending = []
+        cached = {} # dict of name -> hash found in local state
+        for name, read, local, remote in chunk:
+            if not local:
+                continue
+
+            if self.options.force_hash:
+                pending.append(name)
+
+            elif not read or read[2] != local[1] or read[4] != local[3]:
+                size, ml, mtime_ns, inode = local[1:]
+                hash = self.state.digest_of(inode, size, mtime_ns)
+                if hash:
+                    cached[name] = hash
+                else:
+                    pending.append(name)
+
+        fullnames = [ os.path.join(self.cfg.conf['LOCALDIR'], name) for name in pending ]
+        hashes = dict(zip(pending, pool.map(hashof, fullnames, [self.algo]*len(pending))))
+
+        for name, read, local, remote in chunk:
+            hl = ml = hr = mr = None
+
+            if local:
+                size, ml, mtime_ns, inode = local[1:]
+                if name in hashes:
+                    hl = hashes[name]
+                    self.hashed += 1
+                    self.hashed_bytes += size
+                    if self.options.verbosity > 0:
+                        print('[MD5] {0}'.format(fitit(name)))
+                else:
+                    hl = cached.get(name) or read[1]
+                    if self.options.verbosity > 2: # VERY verbose!
+                        print('[SKIP]: {0}'.format(fitit(name)))
+
+                if not read or read[1:] != (hl,) + local[1:]:
+                    out.append((name, hl, size, mtime_ns, inode))
+
+            elif read:
+                gone.append((name, read[1], 0))
+
+            if remote:
+                hr, mr = remote[1], remote[3]
+
+            which = self.classify(name, hl, ml, hr, mr)
+            if which in ('local', 'newlocal'):
+                getattr(self.diff, which).append((name, hl, size, ml, hr))
+            elif which:
+                getattr(self.diff, which).append(remote + (hl,))
+
+    def stream_nuke_remote(self):
+        """Streaming version of nuke_remote()."""
+
+        if self.really_do:
+            hashes = [ entry[1] for entry in self.diff.remote.entries() ]
+            hashes.extend([ entry[4] for entry in self.diff.newlocal.entries() ])
+            hashes = [ h for h in hashes if not self.journal.has('rm', h) and not h in self.catalog and not h in self.chunkmap ]
+            self.remove_remote(hashes)
+            for h in hashes:
+                self.journal.log('rm', h)
+
+    def stream_upload(self):
+        """Streaming version of upload(): encrypt and upload files in chunks, deleting
+        the GPG files in tmpdir after each chunk is uploaded."""
+
+        if not self.really_do:
             return False
 
-        # Then we've been told to check if task was finished, not log it:
-        if what in self.done:
+        # If --size-control, GPG/upload nothing:
+        if self.options.size_control:
             return True
 
-        return False
+        # Upload files as they are GPG-ed (starting with the ones GPG-ed
+        # in a previous interrupted run):
+        uploads = TransferQueue(self)
+        writer = self.pack_writer()
+        try:
+            todo = heapq.merge(self.diff.local.entries(), self.diff.newlocal.entries())
+            for chunk in chunks(todo, self.CHUNK):
+                # Pack small files (see PACK_FILES), and chunk big ones (see CHUNK_FILES):
+                self.pack([ (entry[0], entry[1]) for entry in chunk if entry[2] < self.pack_files ], writer)
+                chunk = [ entry for entry in chunk if entry[2] >= self.pack_files ]
+                if self.chunk_files:
+                    self.split([ (entry[0], entry[1]) for entry in chunk if entry[2] >= self.chunk_files ])
+                    chunk = [ entry for entry in chunk if entry[2] < self.chunk_files ]
+
+                # Skip the ones uploaded in a previous interrupted run:
+                todo = [ (entry[0], entry[1]) for entry in chunk if not self.journal.has('up', entry[1]) ]
+                piped = [ (entry[0], entry[1]) for entry in chunk if self.options.pipe or self.too_big(entry[2]) ]
+                if piped:
+                    self.pipe_files(piped)
+                    piped = set(piped)
+                    todo = [ item for item in todo if not item in piped ]
+                for name, hash in todo:
+                    if self.journal.has('gpg', hash):
+                        uploads.put(hash, self.blob_size(hash))
+                self.gpg_files(todo, done=uploads.put)
+            writer.close()
+        except BaseException:
+            if not uploads.close():
+                return False
+            raise
+
+        if not uploads.close():
+            return False
+
+        self.say_uncompressed()
+
+        return True
+
+    def stream_download(self):
+        """Streaming version of download(): download and un-GPG files in chunks,
+        deleting the GPG files in tmpdir after each chunk. Chunked files (see
+        join_chunks()) are put into place last, once nothing else is staged in
+        tmpdir. Files correctly placed are logged in self.diff.placed, and the ones
+        missing in remote repo in self.diff.missed (or self.diff.missed_chunks, if
+        chunked, for both to be sorted), all of them stream.Spools."""
+
+        self.diff.placed = stream.Spool(os.path.join(self.tmpdir, 'diff.placed'))
+        self.diff.missed = stream.Spool(os.path.join(self.tmpdir, 'diff.missed'))
+        self.diff.missed_chunks = stream.Spool(os.path.join(self.tmpdir, 'diff.missed_chunks'))
+        joins = stream.Spool(os.path.join(self.tmpdir, 'diff.joins')) # chunked files
+
+        dir = self.cfg.conf['REPODIR']
+        server = self.cfg.prefs['REMOTE']
+
+        sizes = {} # dict of hash -> room to take for it, of current chunk
+
+        def sizeof(entry):
+            return self.staged_size(entry[2])
+
+        def unchunked(entries):
+            for entry in entries:
+                if entry[1] in self.chunkmap:
+                    joins.append(entry)
+                else:
+                    yield entry
+
+        def batches():
+            # Download the ones present remotely:
+            todo = unchunked(heapq.merge(self.diff.remote.entries(), self.diff.newremote.entries()))
+            for chunk in chunks(todo, self.CHUNK, self.chunk_bytes(), sizeof):
+                sizes.clear()
+                for entry in chunk:
+                    if not entry[1] in self.catalog: # packed ones are taken from packs
+                        sizes[entry[1]] = sizeof(entry)
+                present = get_present_files(server, dir, sorted(sizes))
+
+                # With --pipe (or if too big for tmpdir), un-GPG them straight from
+                # remote repo into place, instead of downloading them:
+                piped = [ h for h in present if self.options.pipe or self.too_big(sizes[h]) ]
+                if piped:
+                    present = sorted(set(present) - set(piped))
+                yield present, (piped, chunk)
+
+        # With --pipe, nothing is downloaded:
+        if self.options.pipe:
+            for present, (piped, chunk) in batches():
+                self.stream_place(present, chunk, piped)
+
+        else:
+            # Un-GPG each chunk into tmpdir, then move to final destination in local,
+            # while the next one is being downloaded:
+            fetches = FetchQueue(self, batches(), sizes.get)
+            try:
+                for present, (piped, chunk) in fetches:
+                    self.stream_place(present, chunk, piped)
+            finally:
+                ok = fetches.close()
+
+            if not ok:
+                return False
+
+        # Then the chunked ones:
+        for chunk in chunks(joins.entries(), self.CHUNK):
+            self.stream_place([], chunk)
+
+        return True
+
+    def stream_place(self, present, chunk, piped=()):
+        """Streaming version of place(), for the entries in "chunk", whose GPG files
+        of hashes "present" were downloaded (and those of hashes "piped" are to be
+        un-GPG-ed straight from remote repo). Packed ones are taken from their packs,
+        and chunked ones joined from their chunks."""
+
+        left = {} # dict of hash -> files with it left to place
+        for entry in chunk:
+            left.setdefault(entry[1], []).append(entry[0])
+
+        done = {} # dict of hash -> whether put into place already, see place()
+        packed = [ h for h in left if h in self.catalog ]
+        if packed:
+            done.update(self.unpack_packs(packed, left))
+
+        chunked = [ h for h in left if h in self.chunkmap and not h in done ]
+        if chunked:
+            done.update(self.join_chunks(chunked, left))
+
+        if piped:
+            done.update(self.pipe_down(piped, left))
+        self.decrypt(present)
+
+        for entry in chunk:
+            name, hash, size, mtime = entry[:4]
+            left[hash].remove(name)
+            if hash in done:
+                placed = self.unpacked(name, mtime, done[hash])
+            else:
+                placed = self.unpack(name, hash, mtime, last=not left[hash])
+            if placed:
+                st = os.stat(os.path.join(self.cfg.conf['LOCALDIR'], name))
+                self.diff.placed.append((name, hash, size, st.st_mtime_ns, state.inode_of(st)))
+            elif placed is None and hash in self.chunkmap:
+                self.diff.missed_chunks.append(entry)
+            elif placed is None:
+                self.diff.missed.append(entry)
+
+        for hash in present:
+            self.remove_blob(hash)
+
+    def stream_nuke_local(self):
+        """Streaming version of nuke_local()."""
+
+        for name in self.diff.local:
+            cmnd = 'rm -f "%s/%s"' % (self.cfg.conf['LOCALDIR'], name)
+            self.doit(cmnd,2)
 
-    def pickle(self, read=False):
-        """Save/read repos object to/from file."""
+    def stream_save_local(self):
+        """Streaming version of save() of local state, after a download: add the
+        files downloaded, and remove the ones deleted."""
 
-        pickle_file = '{0}/repo.pickle'.format(self.tmpdir)
+        deletes = ()
+        if not self.options.safe:
+            deletes = self.diff.local
 
-        if read: # then read pickled data, not write it.
-            if os.path.isfile(pickle_file): 
-                with open(pickle_file,'rb') as f:
-                    return pickle.load(f)
-            else: # if pickle_file does not exist, do nothing
-                return self
+        self.state.update(self.diff.placed.entries(), deletes)
+
+    def stream_save_remote(self, remote_files):
+        """Streaming version of save() of remote index: apply changes to the
+        (decrypted) remote index files "remote_files", then GPG and upload it."""
+
+        entries = self.stream_remote(remote_files)
+        updates = ()
+        deletes = ()
+        if self.options.up:
+            updates = ( entry[:4] for entry in heapq.merge(self.diff.local.entries(), self.diff.newlocal.entries()) )
+            if not self.options.safe:
+                deletes = self.diff.remote
+        else:
+            deletes = heapq.merge(self.diff.missed, self.diff.missed_chunks)
+
+        self.send_index(stream.overlay(entries, updates, deletes))
+
+        # Record in local state which files were synced with it:
+        if self.options.up:
+            self.state.synced(heapq.merge(self.diff.local, self.diff.newlocal), self.generation)
+        else:
+            self.state.synced(self.diff.placed, self.generation)
+
+# Presence flags of files (see FileTable):
+READ   = 1 # in local state
+LOCAL  = 2 # in local dir
+REMOTE = 4 # in remote repo
+DIRTY  = 8 # inode or mtime changed since local state was saved
+
+DSIZE = 16 # size of (raw) hashes, see HASH_ALGOS
+
+class FileTable(object):
+    """Data of all files (local and remote), stored in columns (one array per
+    attribute, one row per file), to use as little memory as possible. Each row
+    is accessed by name, through a Fileitem view of it. Presence of each file
+    in the local state, local dir and remote repo is kept as a bitmask of READ,
+    LOCAL and REMOTE flags. Hashes are stored raw (an all-zero hash meaning None),
+    sizes as integers, and mtimes as floats. The inode and mtime (in ns) of local
+    files are kept too, for the local state."""
+
+    def __init__(self, repos):
+        self.repos = repos # Repositories object this table belongs to
+        self.rows = {}     # dict of file name -> row (rows are never removed, so
+                           # list(self.rows) gives names in row order)
+
+        self.flags = bytearray()
+
+        self.hash_read   = bytearray()
+        self.hash_local  = bytearray()
+        self.hash_remote = bytearray()
+
+        self.size_read   = array.array('q')
+        self.size_local  = array.array('q')
+        self.size_remote = array.array('q')
+
+        self.mtime_read   = array.array('d')
+        self.mtime_local  = array.array('d')
+        self.mtime_remote = array.array('d')
+
+        self.mtime_ns = array.array('q')
+        self.inode    = array.array('q')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, name):
+        return Fileitem(self, name, self.rows[name])
+
+    def items(self):
+        """Iterate over (name, Fileitem) tuples."""
+
+        for name, row in self.rows.items():
+            yield name, Fileitem(self, name, row)
+
+    def add(self, name):
+        """Add a row for file "name", if not present yet, and return its Fileitem."""
+
+        try:
+            return self[name]
+        except KeyError:
+            pass
+
+        row = len(self.rows)
+        self.rows[name] = row
+
+        self.flags.append(0)
+        for column in self.hash_read, self.hash_local, self.hash_remote:
+            column.extend(bytes(DSIZE))
+        for column in (self.size_read, self.size_local, self.size_remote,
+                       self.mtime_read, self.mtime_local, self.mtime_remote,
+                       self.mtime_ns, self.inode):
+            column.append(0)
+
+        return Fileitem(self, name, row)
+
+    def names(self, flag):
+        """Return list of names of files with flag "flag" set."""
+
+        flags = self.flags
+
+        return [ name for name, row in self.rows.items() if flags[row] & flag ]
+
+def _column(column):
+    """Return property giving access to the value of the row of a Fileitem
+    in column "column" of its FileTable."""
+
+    def get(self):
+        return getattr(self.table, column)[self.row]
+
+    def set(self, value):
+        getattr(self.table, column)[self.row] = value
+
+    return property(get, set)
+
+def _hash_column(column):
+    """Same as _column(), for a column of hashes: the value is given in hex
+    form (or None), but stored raw."""
+
+    def get(self):
+        i = DSIZE*self.row
+        raw = getattr(self.table, column)[i:i+DSIZE]
+        if any(raw):
+            return raw.hex()
+        return None
+
+    def set(self, value):
+        i = DSIZE*self.row
+        if value:
+            getattr(self.table, column)[i:i+DSIZE] = bytes.fromhex(value)
         else:
-            with open(pickle_file,'wb') as f:
-                pickle.dump(self, f)
+            getattr(self.table, column)[i:i+DSIZE] = bytes(DSIZE)
+
+    return property(get, set)
 
 class Fileitem(object):
     """Each of the items of the list of local or remote files, 
-    holding its characteristics.
+    holding its characteristics (actually, a view of its row in a FileTable).
     """
 
-    def __init__(self, name=None, repos=None):
+    __slots__ = ('table', 'name', 'row')
+
+    def __init__(self, table, name, row):
+        self.table = table # FileTable holding the data
         self.name  = name
-        self.repos = repos
+        self.row   = row
 
-        self.size_read   = 0
-        self.size_local  = 0
-        self.size_remote = 0
+    flags = _column('flags')
 
-        self.mtime_read   = 0
-        self.mtime_local  = 0
-        self.mtime_remote = 0
+    size_read   = _column('size_read')
+    size_local  = _column('size_local')
+    size_remote = _column('size_remote')
 
-        self.hash_read   = None
-        self.hash_local  = None
-        self.hash_remote = None
+    mtime_read   = _column('mtime_read')
+    mtime_local  = _column('mtime_local')
+    mtime_remote = _column('mtime_remote')
+
+    hash_read   = _hash_column('hash_read')
+    hash_local  = _hash_column('hash_local')
+    hash_remote = _hash_column('hash_remote')
+
+    mtime_ns = _column('mtime_ns')
+    inode    = _column('inode')
 
     def fullname(self):
         """Return full (local) name of file."""
 
-        return '%s/%s' % (self.repos.cfg.conf['LOCALDIR'], self.name)
+        return '%s/%s' % (self.table.repos.cfg.conf['LOCALDIR'], self.name)
 
     def get_hash(self):
         """Calc hash function for Fileitem."""
 
-        return hashof(self.fullname())
+        return hashof(self.fullname(), self.table.repos.algo)
 
     def get_size(self):
         """Calc file size for Fileitem."""
@@ -1173,8 +3580,453 @@ class RepoDiff(object):
         self.newremote = [] # list of filenames
         self.newremote_hash = {} # dict of hash -> filename 
 
+        # Files downloaded and placed in local dir:
+        self.placed = [] # list of filenames
+
     def sort(self):
         self.local = sorted(self.local)
         self.remote = sorted(self.remote)
         self.newlocal = sorted(self.newlocal)
         self.newremote = sorted(self.newremote)
+
+class Journal(object):
+    """Append-only log of what was done in a run (files GPG-ed, uploaded, removed
+    from remote, downloaded), so that an interrupted run can be resumed without
+    repeating it. Each event is a line with a JSON [event, value] list, written
+    (and flushed) as soon as done."""
+
+    def __init__(self, fn):
+        self.fn = fn       # file where journal is written
+        self.f = None      # file object, open for appending
+        self.events = {}   # dict of event -> set of values
+        self.lock = threading.Lock() # events may be logged from other threads
+
+    def replay(self):
+        """Read events logged in a previous run, if any. Return True if any."""
+
+        if os.path.isfile(self.fn):
+            with open(self.fn) as f:
+                for line in f:
+                    try:
+                        event, value = json.loads(line)
+                    except ValueError:
+                        break # last line may be partial, if interrupted
+
+                    self.events.setdefault(event, set()).add(value)
+
+        return bool(self.events)
+
+    def log(self, event, value):
+        """Log that "event" happened, for "value" (e.g. a file hash)."""
+
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.fn, 'a')
+
+            self.f.write(json.dumps([event, value]) + '\n')
+            self.f.flush()
+            self.events.setdefault(event, set()).add(value)
+
+    def has(self, event, value):
+        """Return True if "event" happened for "value"."""
+
+        return value in self.events.get(event, ())
+
+    def values(self, event):
+        """Return set of values "event" happened for."""
+
+        return self.events.get(event, set())
+
+    def clear(self):
+        """Forget all events."""
+
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+        if os.path.isfile(self.fn):
+            os.unlink(self.fn)
+
+        self.events = {}
+
+class TransferQueue(object):
+    """Queue of GPG files (by hash) to upload from tmpdir to remote repo of
+    Repositories "repos", so that they are uploaded (in a thread of its own) while
+    others are still being GPG-ed. Whenever the thread is idle, it uploads all
+    files queued so far (up to CHUNK), with a single rsync. Uploaded files are
+    logged in the journal, and removed from tmpdir (and their room given back to
+    the budget of "repos"). If an upload fails, the rest are not uploaded, and
+    put() raises the failure. Call close() at the end."""
+
+    def __init__(self, repos):
+        self.repos = repos
+        self.queue = queue.Queue(repos.CHUNK) # bounded, not to fill tmpdir
+        self.hashes = set() # hashes queued so far
+        self.error = None   # exception raised by failed upload, if any
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, hash, size=None):
+        """Queue file of hash "hash" for upload. If "size" is given, that much room
+        is taken from the budget first (see Budget), for files not GPG-ed by
+        Repositories.gpg_files() (which takes it itself)."""
+
+        if self.error is not None:
+            raise self.error
+
+        if not hash in self.hashes:
+            if size is not None:
+                self.repos.budget.take(hash, size)
+            self.hashes.add(hash)
+            self.queue.put(hash)
+
+    def run(self):
+        finished = False
+        while not finished:
+            batch = [ self.queue.get() ]
+            while len(batch) < self.repos.CHUNK:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch: # then close() was called
+                finished = True
+                batch.remove(None)
+
+            if not batch:
+                continue
+
+            try:
+                if self.error is None:
+                    self.repos.transfer(batch)
+            except BaseException as e:
+                self.error = e
+
+            for hash in batch:
+                if self.error is None:
+                    self.repos.journal.log('up', hash)
+                    os.unlink('{0}/data/{1}.gpg'.format(self.repos.tmpdir, hash))
+                self.repos.budget.give(hash)
+
+    def close(self):
+        """Wait for queued files to be uploaded. Return True if all went OK."""
+
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+        return self.error is None
+
+class Budget(object):
+    """Disk space (in bytes) for files staged in tmpdir, "total" at most (no limit
+    if None), shared by the threads staging files and the ones removing them. Room
+    is taken for each file (by a key, e.g. its hash) before staging it, and given
+    back once it is removed."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.used = 0
+        self.taken = {} # dict of key -> bytes taken for it
+        self.cond = threading.Condition()
+
+    def fits(self, n):
+        """Return True if "n" bytes can be taken now. A file bigger than the
+        whole budget fits when nothing else is taken."""
+
+        return self.total is None or not self.used or self.used + n <= self.total
+
+    def take(self, key, n, timeout=None):
+        """Take "n" bytes for "key", waiting up to "timeout" seconds (forever if
+        None) for them to fit. Return False if they did not."""
+
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.fits(n), timeout):
+                return False
+            self.used += n
+            self.taken[key] = self.taken.get(key, 0) + n
+
+        return True
+
+    def give(self, key):
+        """Give back all bytes taken for "key" (if any)."""
+
+        with self.cond:
+            self.used -= self.taken.pop(key, 0)
+            self.cond.notify_all()
+
+class FetchQueue(object):
+    """Download of GPG files from remote repo of Repositories "repos" to tmpdir, in a
+    thread of its own, so that downloaded files can be un-GPG-ed and put into place
+    while the next ones are being downloaded. "batches" is an iterable of (hashes,
+    data) tuples: the files of each batch are downloaded with a single rsync (but
+    the ones already downloaded in a previous interrupted run), and the tuple is
+    then given back by iterating over the object. At most a couple of batches are
+    downloaded ahead, not to fill tmpdir, and room for each file is taken from the
+    budget of "repos" before downloading it (function "sizeof" gives how much, for
+    a hash). It is given back by Repositories.remove_blob(). If a download fails,
+    iteration stops. Call close() at the end."""
+
+    def __init__(self, repos, batches, sizeof):
+        self.repos = repos
+        self.batches = batches
+        self.sizeof = sizeof
+        self.queue = queue.Queue(1)
+        self.error = None    # exception raised by failed download, if any
+        self.stopped = False # whether close() was called
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        journal = self.repos.journal
+        try:
+            for hashes, data in self.batches:
+                if self.stopped:
+                    break
+
+                todo = []
+                for h in hashes:
+                    # Wait for room for it (giving up if close() is called):
+                    while not self.repos.budget.take(h, self.sizeof(h), timeout=0.1):
+                        if self.stopped:
+                            return
+
+                    fn = '{0}/data/{1}.gpg'.format(self.repos.tmpdir, h)
+                    if not journal.has('down', h) or not os.path.exists(fn):
+                        todo.append(h)
+
+                if todo:
+                    self.repos.transfer(todo, up=False)
+                    for h in todo:
+                        journal.log('down', h)
+
+                self.queue.put((hashes, data))
+
+        except BaseException as e:
+            self.error = e
+
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        """Stop downloading, and wait for the thread to finish. Return True if all
+        went OK."""
+
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1) # for it not to block on put()
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+        return self.error is None
+
+class HashCache(object):
+    """Persistent cache of file hashes, keyed by inode and stat data, so that
+    unchanged files are not hashed again, even if renamed, moved or hardlinked."""
+
+    def __init__(self, fn, algo):
+        self.fn = fn         # file where cache is stored
+        self.algo = algo     # hash algorithm of cached hashes
+        self.found = False   # whether cache file was present when read
+        self.entries = {}    # dict of key -> (hash, ctime_ns, name)
+        self.seen = {}       # entries seen in this run (only these are saved)
+
+    @staticmethod
+    def key(st):
+        """Return cache key for stat result "st". Note that ctime is not part of
+        it, because renaming a file updates its ctime in most filesystems."""
+
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def read(self):
+        """Read cache from file, if present."""
+
+        if os.path.isfile(self.fn):
+            with open(self.fn, 'rb') as f:
+                algo, entries = pickle.load(f)
+
+            # Hashes calculated with some other algorithm are of no use:
+            if algo == self.algo:
+                self.entries = entries
+                self.found = True
+
+    def get(self, st, name):
+        """Return cached hash of file "name" with stat result "st", or None if
+        not cached. If the file is at the same path as when cached, its ctime
+        must not have changed either (e.g. content rewritten, then mtime reset)."""
+
+        k = self.key(st)
+        try:
+            hash, ctime, cname = self.entries[k]
+        except KeyError:
+            return None
+
+        if cname == name and ctime != st.st_ctime_ns:
+            return None
+
+        self.seen[k] = (hash, st.st_ctime_ns, name)
+
+        return hash
+
+    def set(self, st, name, hash):
+        """Save hash "hash" of file "name" with stat result "st"."""
+
+        k = self.key(st)
+        self.entries[k] = self.seen[k] = (hash, st.st_ctime_ns, name)
+
+    def save(self):
+        """Save cache to file (only entries seen in this run, to forget
+        about deleted files)."""
+
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((self.algo, self.seen), f)
+        os.replace(tmp, self.fn)
+
+class DirCache(object):
+    """Persistent cache of the listings of local dirs, keyed by the inode and mtime
+    of each dir, so that dirs unchanged since last run need not be listed again (see
+    scantree()). Adding, removing or renaming a file updates the mtime of its dir
+    (but modifying it in place does not, so files are stat-ed anyway). This is only
+    used when asked to (--trust-dirs). The cache is only valid along with the local
+    state it was saved with, as identified by a token."""
+
+    def __init__(self, fn):
+        self.fn = fn      # file where cache is stored
+        self.entries = {} # dict of dir -> (inode, mtime_ns, files, dirs)
+        self.seen = {}    # entries seen in this run (only these are saved)
+
+    def read(self, token):
+        """Read cache from file, if present and saved with token "token"."""
+
+        if token is not None and os.path.isfile(self.fn):
+            with open(self.fn, 'rb') as f:
+                saved, entries = pickle.load(f)
+
+            if saved == token:
+                self.entries = entries
+
+    def get(self, dir, st):
+        """Return cached (files, dirs) tuple of names in dir "dir", with stat
+        result "st", or None if not cached or changed."""
+
+        try:
+            ino, mtime, files, dirs = self.entries[dir]
+        except KeyError:
+            return None
+
+        if ino != st.st_ino or mtime != st.st_mtime_ns:
+            return None
+
+        self.seen[dir] = self.entries[dir]
+
+        return files, dirs
+
+    def set(self, dir, st, files, dirs):
+        """Save names of "files" and "dirs" in dir "dir", with stat result "st"."""
+
+        self.seen[dir] = (st.st_ino, st.st_mtime_ns, tuple(files), tuple(dirs))
+
+    def save(self, token):
+        """Save cache to file, along with token "token"."""
+
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((token, self.seen), f)
+        os.replace(tmp, self.fn)
+
+class Excluder(object):
+    """Matcher of paths (relative to dir "root", the LOCALDIR of the repo)
+    against the EXCLUDES patterns of a repo, compiled once into regular
+    expressions. Patterns can be:
+
+     - plain strings: match if contained anywhere in the absolute path (that is,
+       root + "/" + path), as always.
+     - globs (prefixed with "glob:"): match whole path components, e.g.
+       "glob:*.o" or "glob:.cache*". Use "**" to match across several components.
+     - anchored patterns (prefixed with "root:"): match from the root of the
+       repo, e.g. "root:build" (plain or glob).
+
+    A path matching any pattern implies that all paths under it match too, so
+    excluded dirs can be pruned from the walk.
+    """
+
+    def __init__(self, patts, root=''):
+        self.patts = patts
+        self.root = root.rstrip('/') + '/'
+
+        plain = [] # regexes matched against absolute paths
+        rel = []   # regexes matched against relative paths
+        for patt in patts:
+            if patt.startswith('root:'):
+                rel.append('^' + self.translate(patt[5:].lstrip('/')) + '(?:/|$)')
+            elif patt.startswith('glob:'):
+                rel.append('(?:^|/)' + self.translate(patt[5:]) + '(?:/|$)')
+            elif patt:
+                plain.append(re.escape(patt))
+
+        self.regex = None
+        if plain:
+            self.regex = re.compile('|'.join(plain))
+
+        self.rel_regex = None
+        if rel:
+            self.rel_regex = re.compile('|'.join(rel))
+
+    @staticmethod
+    def translate(patt):
+        """Translate glob "patt" into a regex (where wildcards do not match "/",
+        except for "**")."""
+
+        i, n = 0, len(patt)
+        regex = ''
+        while i < n:
+            c = patt[i]
+            if patt.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 2
+            elif patt.startswith('**', i):
+                regex += '.*'
+                i += 1
+            elif c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and patt.find(']', i+2) > 0:
+                j = patt.find(']', i+2)
+                chars = patt[i+1:j]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[' + chars.replace('\\', '\\\\') + ']'
+                i = j
+            else:
+                regex += re.escape(c)
+            i += 1
+
+        return regex
+
+    def match(self, path):
+        """Return True if "path" matches some pattern, False otherwise."""
+
+        if self.rel_regex is not None and self.rel_regex.search(path):
+            return True
+
+        if self.regex is not None and self.regex.search(self.root + path):
+            return True
+
+        return False
@@ -0,0 +1,497 @@
+"""
+Reading and writing of index files (the local <repo>.md5 file, and the remote
+index.dat), in either of two formats:
+
+ - text: one "name|hash:size:mtime" line per file, after some optional
+   "#key=value" header lines (e.g. "#hash=md5"). Only files with a "#sorted=1"
+   header line are known to be sorted by name (older versions did not sort them).
+
+ - binary: a versioned, column-oriented format, meant to be mmap-ed and
+   accessed in place, without parsing every entry up front:
+
+     header   : magic, version, digest size, hash algorithm, N, size of string table
+     offsets  : N+1 little-endian u64, offset of each path in string table
+     strings  : UTF-8 paths, sorted, concatenated
+     digests  : N raw digests
+     sizes    : N little-endian u64
+     mtimes   : N little-endian i64, in nanoseconds
+
+The remote index can also be split into shards (see INDEX_SHARDS in README),
+each of them an index file of its own (in either format), holding the entries
+of the files in some dirs (see shard_of()).
+
+The digests of all dirs of an index, computed bottom-up (see DirDigests), can
+be saved in a text file of their own, with one "dir|digest" line per dir, after
+some optional "#key=value" header lines (see write_digests()).
+
+To convert an index from one format to the other:
+
+% python -m libgipsync.index [--text] source destination
+"""
+
+# Standard libs:
+import os
+import sys
+import mmap
+import array
+import shutil
+import hashlib
+import struct
+import argparse
+
+# Constants:
+MAGIC = b'GIPSYNCX'
+VERSION = 1
+HEADER = '<8sHH16sQQ' # magic, version, digest size, algo, N, string table size
+
+# Functions:
+def is_binary(fn):
+    """Return True if file "fn" is an index in binary format."""
+
+    with open(fn, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def is_sorted(fn):
+    """Return True if the entries in index file "fn" are known to be sorted by
+    name: always in binary format, only if it says so in text format."""
+
+    if is_binary(fn):
+        return True
+
+    with open(fn) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.rstrip('\n') == '#sorted=1':
+                return True
+
+    return False
+
+def read_index(fn):
+    """Read index file "fn", in whatever format. Return a tuple with the hash
+    algorithm used, and an iterator of (name, hash, size, mtime) tuples, with
+    the hash in hex form and mtime in seconds."""
+
+    if is_binary(fn):
+        idx = BinaryIndex(fn)
+        return idx.algo, idx.entries()
+
+    return read_text(fn)
+
+def read_text(fn):
+    """Read index file "fn" in text format. Return same as read_index()."""
+
+    header = {}
+    f = open(fn)
+
+    # Read header lines:
+    line = f.readline()
+    while line.startswith('#'):
+        k, _, v = line[1:].rstrip('\n').partition('=')
+        header[k] = v
+        line = f.readline()
+
+    def entries(line):
+        with f:
+            while line:
+                line = line.rstrip('\n')
+                if line and not line[0] == '#': # ignore blank lines and comments
+                    name, _, value = line.partition('|')
+                    av = value.split(':')
+
+                    if len(av) < 3:
+                        msj = 'The length of dictionary entry "{0}|{1}" is too short!'.format(name, value)
+                        sys.exit(msj)
+
+                    yield name, av[0], int(float(av[1])), float(av[2])
+
+                line = f.readline()
+
+    return header.get('hash', 'md5'), entries(line)
+
+def write_index(fn, entries, algo, binary=False, presorted=False):
+    """Write index file "fn", in binary format if "binary" is True, in text
+    format otherwise. "entries" is an iterable of (name, hash, size, mtime)
+    tuples, as given by read_index(). Entries are saved sorted by name (they are
+    sorted in memory first, unless "presorted" is True)."""
+
+    if not presorted:
+        entries = sorted(entries)
+
+    w = writer(fn, algo, binary)
+    for entry in entries:
+        w.write(*entry)
+    w.close()
+
+def writer(fn, algo, binary=False):
+    """Return a writer object for index file "fn", in binary or text format. Entries
+    must be given to its write() method sorted by name, and its close() method be
+    called at the end."""
+
+    if binary:
+        return BinaryWriter(fn, algo)
+
+    return TextWriter(fn, algo)
+
+def shard_of(name, n):
+    """Return which of "n" shards the entry of file "name" goes to. All files in
+    the same dir go to the same shard, so that changes in a dir touch a single
+    shard."""
+
+    dir = os.path.dirname(name).encode('utf-8', 'surrogateescape')
+
+    return int.from_bytes(hashlib.md5(dir).digest()[:4], 'little') % n
+
+def convert(src, dst, binary=True):
+    """Convert index file "src" (in whatever format) into "dst", in binary or
+    text format."""
+
+    algo, entries = read_index(src)
+    write_index(dst, entries, algo, binary=binary)
+
+def write_digests(fn, digests, **header):
+    """Write dict of dir -> digest "digests" (see DirDigests) to file "fn", with
+    the items in "header" as header lines."""
+
+    with open(fn + '.tmp', 'w') as f:
+        for k, v in sorted(header.items()):
+            f.write('#{0}={1}\n'.format(k, v))
+        for dir, digest in sorted(digests.items()):
+            f.write('{0}|{1}\n'.format(dir, digest))
+    os.replace(fn + '.tmp', fn)
+
+def read_digests(fn):
+    """Inverse of write_digests(): return a (header, digests) tuple of dicts."""
+
+    header = {}
+    digests = {}
+    with open(fn) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                k, _, v = line[1:].partition('=')
+                header[k] = v
+            elif line:
+                dir, _, digest = line.rpartition('|')
+                digests[dir] = digest
+
+    return header, digests
+
+# Classes:
+class DirDigests(object):
+    """Digests of the dirs of an index, computed bottom-up (a Merkle tree): that of
+    each dir is the MD5 of the entries of the files right in it (name, hash, size
+    and mtime in whole seconds), followed by the names and digests of its subdirs.
+    Equal digests mean equal subtrees. Give all entries to add(), sorted by name
+    (or at least, those in each dir), then call digests(). The top dir is ''."""
+
+    def __init__(self):
+        self.files = {} # dict of dir -> MD5 object of the files right in it
+
+    def add(self, name, hash, size, mtime):
+        dir, _, base = name.rpartition('/')
+        try:
+            h = self.files[dir]
+        except KeyError:
+            h = self.files[dir] = hashlib.md5()
+
+        line = '{0}|{1}:{2}:{3}\n'.format(base, hash, size, int(float(mtime)))
+        h.update(line.encode('utf-8', 'surrogateescape'))
+
+    def feed(self, entries):
+        """Iterate over (name, hash, size, mtime, ...) tuples "entries", adding
+        each before yielding it."""
+
+        for entry in entries:
+            self.add(*entry[:4])
+            yield entry
+
+    def digests(self):
+        """Return dict of dir -> digest (in hex form) of all dirs."""
+
+        # Subdirs of each dir (dirs with no files right in them included):
+        subdirs = {}
+        for dir in self.files:
+            while dir:
+                parent = dir.rpartition('/')[0]
+                kids = subdirs.setdefault(parent, set())
+                if dir in kids:
+                    break
+                kids.add(dir)
+                dir = parent
+
+        # Deepest first, for the digests of subdirs to be there already:
+        dirs = set(self.files) | set(subdirs)
+        depth = lambda dir: dir.count('/') + 1 if dir else 0
+
+        digests = {}
+        for dir in sorted(dirs, key=depth, reverse=True):
+            h = self.files[dir].copy() if dir in self.files else hashlib.md5()
+            h.update(b'/\n') # files end here
+            for sub in sorted(subdirs.get(dir, ())):
+                line = '{0}|{1}\n'.format(sub.rpartition('/')[2], digests[sub])
+                h.update(line.encode('utf-8', 'surrogateescape'))
+            digests[dir] = h.hexdigest()
+
+        return digests
+
+class TextWriter(object):
+    """Incremental writer of index file in text format. See writer()."""
+
+    def __init__(self, fn, algo):
+        self.fn = fn
+        self.f = open(fn + '.tmp', 'w')
+        self.f.write('#hash={0}\n'.format(algo))
+        self.f.write('#sorted=1\n')
+
+    def write(self, name, hash, size, mtime):
+        self.f.write('{0}|{1}:{2}:{3}\n'.format(name, hash, size, mtime))
+
+    def close(self):
+        self.f.close()
+        os.replace(self.fn + '.tmp', self.fn)
+
+class BinaryWriter(object):
+    """Incremental writer of index file in binary format. See writer(). Columns
+    are spilled to temporary files as they grow, and put together at close()."""
+
+    FLUSH = 65536 # entries to buffer before spilling to disk
+
+    def __init__(self, fn, algo):
+        self.fn = fn
+        self.algo = algo
+        self.n = 0
+        self.ssize = 0
+        self.dsize = None
+
+        self.columns = {}
+        self.files = {} # spill files (only opened if needed)
+        for column, typecode in ('offsets', 'Q'), ('strings', None), ('digests', None), ('sizes', 'Q'), ('mtimes', 'q'):
+            if typecode:
+                self.columns[column] = array.array(typecode)
+            else:
+                self.columns[column] = bytearray()
+        self.columns['offsets'].append(0)
+
+    def write(self, name, hash, size, mtime):
+        name = name.encode('utf-8', 'surrogateescape')
+        digest = bytes.fromhex(hash)
+        if self.dsize is None:
+            self.dsize = len(digest)
+        elif len(digest) != self.dsize:
+            raise ValueError('Hash "{0}" of "{1}" has wrong length'.format(hash, name))
+
+        self.ssize += len(name)
+        self.columns['strings'] += name
+        self.columns['offsets'].append(self.ssize)
+        self.columns['digests'] += digest
+        self.columns['sizes'].append(int(size))
+        self.columns['mtimes'].append(int(round(float(mtime)*1e9)))
+        self.n += 1
+
+        if self.n % self.FLUSH == 0:
+            self.flush()
+
+    def flush(self):
+        """Spill buffered columns to their temporary files."""
+
+        for column, data in self.columns.items():
+            if column not in self.files:
+                self.files[column] = open('{0}.{1}'.format(self.fn, column), 'w+b')
+
+            if isinstance(data, array.array):
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                data.tofile(self.files[column])
+                del data[:]
+            else:
+                self.files[column].write(data)
+                data.clear()
+
+    def close(self):
+        header = struct.pack(HEADER, MAGIC, VERSION, self.dsize or 16,
+                             self.algo.encode('ascii'), self.n, self.ssize)
+
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(header)
+
+            if not self.files:
+                # Small enough to be all in memory:
+                for column in 'offsets', 'strings', 'digests', 'sizes', 'mtimes':
+                    data = self.columns[column]
+                    if isinstance(data, array.array) and sys.byteorder != 'little':
+                        data.byteswap()
+                    f.write(data)
+            else:
+                self.flush()
+                for column in 'offsets', 'strings', 'digests', 'sizes', 'mtimes':
+                    cf = self.files[column]
+                    cf.seek(0)
+                    shutil.copyfileobj(cf, f)
+                    cf.close()
+                    os.unlink(cf.name)
+        os.replace(tmp, self.fn)
+
+class ShardWriter(object):
+    """Incremental writer of an index split into "n" shards, as index files named
+    after the number of each shard, in dir "dir" (only non-empty shards are
+    written). Entries must be given to write() sorted by name, and close() be
+    called at the end, which returns a dict of shard number -> file name."""
+
+    def __init__(self, dir, n, algo, binary=False):
+        self.dir = dir
+        self.n = n
+        self.algo = algo
+        self.binary = binary
+        self.writers = {} # dict of shard number -> writer
+
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def write(self, name, hash, size, mtime):
+        i = shard_of(name, self.n)
+        try:
+            w = self.writers[i]
+        except KeyError:
+            w = self.writers[i] = writer(os.path.join(self.dir, str(i)), self.algo, self.binary)
+
+        w.write(name, hash, size, mtime)
+
+    def close(self):
+        files = {}
+        for i, w in self.writers.items():
+            w.close()
+            files[i] = w.fn
+
+        return files
+
+class BinaryIndex(object):
+    """Index file in binary format, mmap-ed. Entries (sorted by name) can be accessed
+    by position, without parsing the whole file. Call close() at the end (or use
+    it as a context manager)."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+        with open(fn, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, dsize, algo, n, ssize = struct.unpack_from(HEADER, self.map)
+        if magic != MAGIC:
+            raise ValueError('"{0}" is not a binary index file'.format(fn))
+        if version != VERSION:
+            raise ValueError('"{0}" has unsupported index version {1}'.format(fn, version))
+
+        self.algo = algo.rstrip(b'\0').decode('ascii')
+        self.dsize = dsize
+        self.n = n
+
+        # Locate columns (keeping all views of the map, to release them at close()):
+        mv = memoryview(self.map)
+        self.views = [ mv ]
+        pos = struct.calcsize(HEADER)
+
+        self.offsets = self.column(mv[pos:pos + 8*(n+1)], 'Q')
+        pos += 8*(n+1)
+
+        self.strings = mv[pos:pos + ssize]
+        self.views.append(self.strings)
+        pos += ssize
+
+        self.digests = mv[pos:pos + dsize*n]
+        self.views.append(self.digests)
+        pos += dsize*n
+
+        self.sizes = self.column(mv[pos:pos + 8*n], 'Q')
+        pos += 8*n
+
+        self.mtimes = self.column(mv[pos:pos + 8*n], 'q')
+
+    def column(self, mv, typecode):
+        """Return a sequence of integers of type "typecode" from little-endian
+        buffer "mv" (in place, if we are little-endian too)."""
+
+        self.views.append(mv)
+        if sys.byteorder == 'little':
+            column = mv.cast(typecode)
+            self.views.append(column)
+            return column
+
+        column = array.array(typecode, mv.tobytes())
+        column.byteswap()
+
+        return column
+
+    def close(self):
+        """Release the map (and all views of it)."""
+
+        for mv in reversed(self.views):
+            mv.release()
+        self.views = []
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    def entries(self):
+        """Iterate over all entries (see __getitem__()), and close() at the end."""
+
+        try:
+            for entry in self:
+                yield entry
+        finally:
+            self.close()
+
+    def __getitem__(self, i):
+        """Return i-th entry, as a (name, hash, size, mtime) tuple."""
+
+        return self.name(i), self.hash(i), self.sizes[i], self.mtimes[i]/1e9
+
+    def name(self, i):
+        """Return name of i-th entry."""
+
+        raw = self.strings[self.offsets[i]:self.offsets[i+1]]
+
+        return str(raw, 'utf-8', 'surrogateescape')
+
+    def hash(self, i):
+        """Return hash of i-th entry, in hex form."""
+
+        return self.digests[self.dsize*i:self.dsize*(i+1)].hex()
+
+
+def main():
+    """Convert an index file between text and binary formats."""
+
+    parser = argparse.ArgumentParser(description='Convert a gipsync index file between formats.')
+
+    parser.add_argument('source',
+                      help="Index file to read (in any format).")
+
+    parser.add_argument('destination',
+                      help="Index file to write.")
+
+    parser.add_argument("-t", "--text",
+                      help="Write text format. Default: binary format.",
+                      action="store_true",
+                      default=False)
+
+    o = parser.parse_args()
+
+    convert(o.source, o.destination, binary=not o.text)
+
+
+# Main:
+if __name__ == "__main__":
+    main()
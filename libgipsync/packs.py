@@ -0,0 +1,189 @@
+"""
+Packing of small files into bigger blobs (see PACK_FILES in README), to save on
+gpg runs, transfers and files in the remote repo. A pack is the concatenation of
+the contents of some files (each stored once, whatever the number of files with
+it), GPG-ed as a whole, and stored in the packs/ dir of the remote repo, named
+after a random id. Which pack holds the contents with each hash, and where in
+it, is kept in a catalog, GPG-ed and uploaded along with the remote index, as
+packs.dat. It is a text file, like this:
+
+    #hash=<algo>
+    #pack=<id>:<size>             (one line per pack)
+    <hash>|<id>:<offset>:<size>   (one line per packed hash)
+
+Packs left mostly dead as files are removed or changed (or too small) are
+repacked, see Catalog.garbage().
+"""
+
+# Standard libs:
+import os
+import sys
+
+# Constants:
+GC_RATIO = 0.5     # packs with less than this fraction of their contents alive are repacked
+SMALL_RATIO = 0.25 # packs smaller than this fraction of the pack size are merged together
+
+# Classes:
+class Catalog(object):
+    """Catalog of the contents in packs, for hashes calculated with algorithm
+    "algo"."""
+
+    def __init__(self, algo):
+        self.algo = algo
+        self.packs = {}   # dict of pack id -> size
+        self.entries = {} # dict of hash -> (pack id, offset, size)
+        self.changed = False
+
+    def __contains__(self, hash):
+        return hash in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, hash):
+        """Return (pack id, offset, size) tuple of "hash"."""
+
+        return self.entries[hash]
+
+    def read(self, fn):
+        """Read catalog from file "fn"."""
+
+        with open(fn) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('#'):
+                    k, _, v = line[1:].partition('=')
+                    if k == 'hash':
+                        self.algo = v
+                    elif k == 'pack':
+                        pack, _, size = v.partition(':')
+                        self.packs[pack] = int(size)
+
+                elif line:
+                    hash, _, value = line.partition('|')
+                    pack, offset, size = value.split(':')
+                    # All entries of a pack share its id, instead of holding a copy each:
+                    self.entries[hash] = (sys.intern(pack), int(offset), int(size))
+
+    def write(self, fn):
+        """Write catalog to file "fn"."""
+
+        with open(fn + '.tmp', 'w') as f:
+            f.write('#hash={0}\n'.format(self.algo))
+            for pack, size in sorted(self.packs.items()):
+                f.write('#pack={0}:{1}\n'.format(pack, size))
+            for hash, (pack, offset, size) in sorted(self.entries.items()):
+                f.write('{0}|{1}:{2}:{3}\n'.format(hash, pack, offset, size))
+        os.replace(fn + '.tmp', fn)
+
+    def add(self, pack, size, members):
+        """Add pack "pack", of "size" bytes, holding "members", a list of (hash,
+        offset, size) tuples. Hashes already in other packs are moved to it."""
+
+        self.packs[pack] = size
+        for hash, offset, n in members:
+            self.entries[hash] = (pack, offset, n)
+        self.changed = True
+
+    def keep(self, hashes):
+        """Forget all hashes but those in "hashes" (e.g. a set)."""
+
+        dead = [ h for h in self.entries if not h in hashes ]
+        for h in dead:
+            del self.entries[h]
+
+        if dead:
+            self.changed = True
+
+    def members(self, packs):
+        """Return list of (hash, offset, size) tuples of the hashes in packs with
+        ids in "packs", sorted by pack and offset."""
+
+        packs = set(packs)
+        lista = [ (pack, offset, hash, size) for hash, (pack, offset, size) in self.entries.items() if pack in packs ]
+
+        return [ (hash, offset, size) for pack, offset, hash, size in sorted(lista) ]
+
+    def garbage(self, pack_size):
+        """Return a tuple with the lists of ids of packs with no hash alive (to be
+        removed), and of those with little alive (to be repacked): less than
+        GC_RATIO of their contents, or smaller than SMALL_RATIO of "pack_size",
+        if there are more than one of those (to be merged)."""
+
+        live = dict.fromkeys(self.packs, 0)
+        for pack, offset, size in self.entries.values():
+            live[pack] += size
+
+        empty = sorted( pack for pack, n in live.items() if not n )
+        repack = sorted( pack for pack, n in live.items() if n and n < GC_RATIO*self.packs[pack] )
+
+        small = sorted( pack for pack, n in live.items() if n and not pack in repack and self.packs[pack] < SMALL_RATIO*pack_size )
+        if len(small) > 1:
+            repack.extend(small)
+
+        return empty, repack
+
+    def drop(self, packs):
+        """Forget packs with ids in "packs", and the hashes still in them."""
+
+        packs = set(packs)
+        for pack in packs:
+            self.packs.pop(pack, None)
+
+        dead = [ h for h, entry in self.entries.items() if entry[0] in packs ]
+        for h in dead:
+            del self.entries[h]
+
+        if packs:
+            self.changed = True
+
+    def rekey(self, rekey, algo):
+        """Re-key hashes to algorithm "algo", as given by "rekey" (dict of old
+        hash -> new hash). Hashes not in it are forgotten."""
+
+        self.entries = dict( (rekey[h], entry) for h, entry in self.entries.items() if h in rekey )
+        self.algo = algo
+        self.changed = True
+
+class PackWriter(object):
+    """Writer of packs of about "size" bytes (at least, but for the last one), as
+    plaintext files in dir "dir", named after their (random) id. Contents are
+    given to add(), and close() must be called at the end. Each time a pack is
+    complete, function "done" is called with its id, the path of its file, its
+    size, and the list of (hash, offset, size) tuples of its members."""
+
+    def __init__(self, dir, size, done):
+        self.dir = dir
+        self.size = size
+        self.done = done
+        self.f = None
+        self.members = []
+        self.hashes = set() # hashes added so far
+
+    def add(self, hash, data):
+        """Add contents "data" (bytes) with hash "hash" to current pack."""
+
+        if self.f is None:
+            self.id = os.urandom(16).hex()
+            self.fn = os.path.join(self.dir, self.id)
+            self.f = open(self.fn, 'wb')
+            self.members = []
+
+        self.members.append((hash, self.f.tell(), len(data)))
+        self.hashes.add(hash)
+        self.f.write(data)
+
+        if self.f.tell() >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Complete current pack (if any)."""
+
+        if self.f is not None:
+            size = self.f.tell()
+            self.f.close()
+            self.f = None
+            self.done(self.id, self.fn, size, self.members)
+
+    def close(self):
+        self.flush()
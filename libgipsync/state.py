@@ -0,0 +1,228 @@
+"""
+Local state of a repo (what the local files were like as of the last run), kept
+in a SQLite database (~/.gipsync/<repo>.db), instead of a whole index file
+rewritten each time. For each file, it holds:
+
+ - path       : relative to LOCALDIR (raw UTF-8, see encode())
+ - digest     : raw hash of its contents
+ - size       : in bytes
+ - mtime_ns   : modification time, in nanoseconds
+ - inode      : inode number
+ - generation : generation of the remote index it was last synced with (NULL
+                if changed since then, or never synced)
+
+plus some key/value pairs in a "meta" table (e.g. the hash algorithm used), and
+the digest of each dir (see index.DirDigests) in a "dirs" table.
+Paths and inodes are indexed, so that looking up a file by either does not need
+reading the whole table (see digest_of()). Changes are written in batched
+transactions, and only for the files that changed.
+"""
+
+# Standard libs:
+import os
+import sqlite3
+import itertools
+
+# Our libs:
+from libgipsync import index
+
+# Constants:
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path       BLOB PRIMARY KEY,
+    digest     BLOB NOT NULL,
+    size       INTEGER NOT NULL,
+    mtime_ns   INTEGER NOT NULL,
+    inode      INTEGER NOT NULL,
+    generation TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dirs (
+    path   BLOB PRIMARY KEY,
+    digest BLOB NOT NULL
+) WITHOUT ROWID;
+DROP INDEX IF EXISTS files_digest;
+CREATE INDEX IF NOT EXISTS files_inode ON files (inode);
+'''
+
+BATCH = 10000 # rows written per transaction
+
+# Functions:
+def encode(name):
+    """Return file name "name" as stored in database: raw UTF-8 bytes (so that
+    names not valid UTF-8 are kept as they are, and valid ones sort by code point,
+    as in Python)."""
+
+    return name.encode('utf-8', 'surrogateescape')
+
+def decode(raw):
+    """Inverse of encode()."""
+
+    return raw.decode('utf-8', 'surrogateescape')
+
+def inode_of(st):
+    """Return inode number of stat result "st", as stored in database (SQLite
+    integers are signed 64-bit, so the top bit is dropped)."""
+
+    return st.st_ino & 0x7fffffffffffffff
+
+def batches(items, size=BATCH):
+    """Yield lists of up to "size" items from iterable "items"."""
+
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+# Classes:
+class LocalState(object):
+    """Local state of a repo, in SQLite database "fn" (created if not present),
+    for hashes calculated with algorithm "algo". If it holds hashes calculated
+    with some other algorithm, it is considered empty, and wiped on next update."""
+
+    def __init__(self, fn, algo):
+        self.fn = fn
+        self.algo = algo
+
+        self.db = sqlite3.connect(fn)
+        self.db.executescript(SCHEMA)
+
+    def get(self, key):
+        """Return value of "key" in meta table, or None if not there."""
+
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0]
+
+        return None
+
+    def set(self, key, value):
+        """Set value of "key" in meta table (must be called within a transaction)."""
+
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def empty(self):
+        """Return True if nothing was ever saved."""
+
+        return self.get('hash') is None
+
+    def stale(self, algo=None):
+        """Return True if saved hashes were calculated with an algorithm other
+        than "algo" (by default, the one of the repo)."""
+
+        return self.get('hash') not in (None, algo or self.algo)
+
+    def entries(self):
+        """Iterate over (name, hash, size, mtime, mtime_ns, inode) tuples of all
+        files, sorted by name, with the hash in hex form and mtime in (whole)
+        seconds, as calculated by Repositories.walk()."""
+
+        if self.stale():
+            return
+
+        cursor = self.db.execute('SELECT path, digest, size, mtime_ns, inode FROM files ORDER BY path')
+        for path, digest, size, mtime_ns, inode in cursor:
+            yield decode(path), digest.hex(), size, mtime_ns // 1000000000, mtime_ns, inode
+
+    def update(self, rows=(), deletes=(), algo=None):
+        """Save the files in "rows", an iterable of (name, hash, size, mtime_ns,
+        inode) tuples (replacing the old data, if any), and remove the ones with
+        names in iterable "deletes". Hashes are calculated with algorithm "algo"
+        (by default, the one of the repo). A new token is set afterwards (see
+        token()), if anything changed."""
+
+        algo = algo or self.algo
+        changed = self.stale(algo) or self.empty()
+        with self.db:
+            if self.stale(algo):
+                self.db.execute('DELETE FROM files')
+            self.set('hash', algo)
+
+        sql = 'INSERT OR REPLACE INTO files (path, digest, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)'
+        rows = ( (encode(name), bytes.fromhex(hash), size, mtime_ns, inode) for name, hash, size, mtime_ns, inode in rows )
+        for batch in batches(rows):
+            changed = True
+            with self.db:
+                self.db.executemany(sql, batch)
+
+        sql = 'DELETE FROM files WHERE path = ?'
+        for batch in batches( (encode(name),) for name in deletes ):
+            changed = True
+            with self.db:
+                self.db.executemany(sql, batch)
+
+        if changed:
+            with self.db:
+                self.set('token', os.urandom(8).hex())
+
+    def synced(self, names, generation):
+        """Record that files in iterable "names" were synced with generation
+        "generation" of the remote index."""
+
+        sql = 'UPDATE files SET generation = ? WHERE path = ?'
+        for batch in batches( (generation, encode(name)) for name in names ):
+            with self.db:
+                self.db.executemany(sql, batch)
+
+        with self.db:
+            self.set('generation', generation)
+
+    def token(self):
+        """Return a token that changes each time the state is updated (or None
+        if never saved)."""
+
+        return self.get('token')
+
+    def dir_digests(self):
+        """Return dict of dir -> digest (in hex form) of all dirs, as saved with
+        save_dir_digests(), or None if the files changed since then."""
+
+        if self.get('dirs') is None or self.get('dirs') != self.token():
+            return None
+
+        cursor = self.db.execute('SELECT path, digest FROM dirs')
+
+        return dict( (decode(path), digest.hex()) for path, digest in cursor )
+
+    def save_dir_digests(self, digests):
+        """Save dict of dir -> digest "digests", as those of the files as they are
+        now (see dir_digests())."""
+
+        with self.db:
+            self.db.execute('DELETE FROM dirs')
+            sql = 'INSERT INTO dirs (path, digest) VALUES (?, ?)'
+            self.db.executemany(sql, ( (encode(dir), bytes.fromhex(digest)) for dir, digest in digests.items() ))
+            self.set('dirs', self.token())
+
+    def digest_of(self, inode, size, mtime_ns):
+        """Return hash (in hex form) of some file with inode "inode", "size" bytes
+        long and modified at "mtime_ns", or None if there is none (e.g. to reuse it
+        for files renamed, moved, or hardlinked since last run)."""
+
+        if not inode or self.stale(): # inode unknown (see load_index()), or of no use
+            return None
+
+        sql = 'SELECT digest FROM files WHERE inode = ? AND size = ? AND mtime_ns = ? LIMIT 1'
+        row = self.db.execute(sql, (inode, size, mtime_ns)).fetchone()
+        if row:
+            return row[0].hex()
+
+        return None
+
+    def load_index(self, fn):
+        """Import the files listed in index file "fn" (e.g. the <repo>.md5 file
+        of older versions). Their inode numbers are unknown, so they are saved
+        again after the next dir walk."""
+
+        algo, entries = index.read_index(fn)
+        rows = ( (name, hash, size, int(round(float(mtime)*1e9)), 0) for name, hash, size, mtime in entries )
+
+        self.update(rows, algo=algo)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,187 @@
+"""
+Tools to handle file lists too large to fit in memory, as streams of tuples
+sorted by file name (the first item of each tuple):
+
+ - Sorter: sorts a stream of any length, spilling sorted runs to disk, and
+   merging them back (k-way) when iterated over.
+
+ - merge_join(): k-way merge join of sorted streams, by name.
+
+ - overlay(): apply updates and deletions (sorted streams) to a sorted stream.
+
+ - Spool: list of tuples kept on disk, in the order they were appended.
+"""
+
+# Standard libs:
+import os
+import heapq
+import pickle
+
+# Constants:
+RUN_SIZE = 100000 # items to sort in memory, before spilling a run to disk
+BLOCK = 1000      # items per pickle block, when writing runs/spools
+
+# Functions:
+def merge_join(*streams):
+    """Merge join the given streams, each sorted by name and with unique names.
+    Yield one (name, item1, item2, ...) tuple per distinct name, with the item of
+    each stream for that name, or None if the stream holds no such name."""
+
+    n = len(streams)
+    iters = [ iter(s) for s in streams ]
+    heap = []
+
+    def push(i, last=None):
+        for item in iters[i]:
+            if last is not None and item[0] <= last:
+                raise ValueError('Stream not sorted by name, at "{0}"'.format(item[0]))
+            heapq.heappush(heap, (item[0], i, item))
+            return
+
+    for i in range(n):
+        push(i)
+
+    while heap:
+        name = heap[0][0]
+        row = [None]*n
+        while heap and heap[0][0] == name:
+            _, i, item = heapq.heappop(heap)
+            row[i] = item
+            push(i, name)
+        yield (name,) + tuple(row)
+
+def overlay(base, updates=(), deletes=()):
+    """Yield the items of sorted stream "base", with the items in sorted stream
+    "updates" replacing (or adding to) those with the same name, and leaving out
+    those with names in sorted stream "deletes" (unless updated)."""
+
+    deletes = ( (name,) for name in deletes )
+    for name, item, update, delete in merge_join(base, updates, deletes):
+        if update:
+            yield update
+        elif item and not delete:
+            yield item
+
+def write_blocks(f, items):
+    """Pickle "items" into file object "f", in blocks of BLOCK items."""
+
+    block = []
+    for item in items:
+        block.append(item)
+        if len(block) >= BLOCK:
+            pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+            block = []
+    if block:
+        pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+
+def read_blocks(fn):
+    """Yield the items pickled in file "fn" by write_blocks()."""
+
+    with open(fn, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+# Classes:
+class Sorter(object):
+    """External sort of tuples. Add them with add(), then iterate over the object
+    (as many times as needed) to get them sorted. At most "run_size" items are
+    held in memory. Spilled runs go to files named after "prefix"."""
+
+    def __init__(self, prefix, run_size=RUN_SIZE):
+        self.prefix = prefix
+        self.run_size = run_size
+        self.buffer = []
+        self.runs = [] # file names of sorted runs
+
+    def add(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        """Save items in buffer to disk, as a sorted run."""
+
+        self.buffer.sort()
+        fn = '{0}.run{1}'.format(self.prefix, len(self.runs))
+        with open(fn, 'wb') as f:
+            write_blocks(f, self.buffer)
+        self.runs.append(fn)
+        self.buffer = []
+
+    def __iter__(self):
+        self.buffer.sort()
+        runs = [ read_blocks(fn) for fn in self.runs ]
+
+        return heapq.merge(self.buffer, *runs)
+
+    def close(self):
+        """Remove spilled runs."""
+
+        for fn in self.runs:
+            os.unlink(fn)
+        self.runs = []
+        self.buffer = []
+
+class Spool(object):
+    """List of (name, hash, size, ...) tuples kept on disk, in file "fn". Iterating
+    over it yields the names only, so that it can be used in place of the lists of
+    a RepoDiff. Use entries() to get whole tuples. The total size of the files in
+    it is kept in the "size" attribute."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.n = 0
+        self.size = 0
+        self.block = []
+        open(fn, 'wb').close()
+
+    def append(self, entry):
+        self.block.append(entry)
+        self.n += 1
+        self.size += entry[2]
+        if len(self.block) >= BLOCK:
+            self.flush()
+
+    def flush(self):
+        if self.block:
+            with open(self.fn, 'ab') as f:
+                pickle.dump(self.block, f, pickle.HIGHEST_PROTOCOL)
+            self.block = []
+
+    def __len__(self):
+        return self.n
+
+    def __bool__(self):
+        return self.n > 0
+
+    def entries(self):
+        """Yield all entries, in the order they were appended."""
+
+        self.flush()
+        for entry in read_blocks(self.fn):
+            yield entry
+
+    def __iter__(self):
+        for entry in self.entries():
+            yield entry[0]
+
+class StreamDiff(object):
+    """Difference between local and remote repos, like RepoDiff, but with the
+    lists held on disk (as Spools), in dir "dir". Entries are appended in name
+    order, so each list is sorted."""
+
+    def __init__(self, dir):
+        self.local     = Spool(os.path.join(dir, 'diff.local'))     # files only in local
+        self.remote    = Spool(os.path.join(dir, 'diff.remote'))    # files only in remote
+        self.newlocal  = Spool(os.path.join(dir, 'diff.newlocal'))  # files newer in local
+        self.newremote = Spool(os.path.join(dir, 'diff.newremote')) # files newer in remote
+
+    def sort(self):
+        """Nothing to do: lists are sorted already."""
+
+        pass